@@ -5,6 +5,8 @@ import urllib.request
 import urllib.error
 import psycopg2
 
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Verify Telegram bot token, save it to DB, and set webhook
@@ -56,7 +58,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    telegram_api_url = f'https://api.telegram.org/bot{token}/getMe'
+    telegram_api_url = f'{TELEGRAM_API_URL}/bot{token}/getMe'
     
     try:
         req = urllib.request.Request(telegram_api_url)
@@ -95,7 +97,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             webhook_url = body_data.get('webhook_url', '')
             if webhook_url:
-                webhook_api_url = f'https://api.telegram.org/bot{token}/setWebhook'
+                webhook_api_url = f'{TELEGRAM_API_URL}/bot{token}/setWebhook'
                 webhook_data = json.dumps({'url': webhook_url}).encode('utf-8')
                 webhook_req = urllib.request.Request(webhook_api_url, data=webhook_data, headers={'Content-Type': 'application/json'})
                 try:
@@ -0,0 +1,119 @@
+import argparse
+import json
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterator, Callable
+
+import index
+
+class QueryCounter:
+    """Считает взятия соединений и выполненные запросы через index.get_db_connection"""
+    
+    def __init__(self):
+        self.connections = 0
+        self.queries = 0
+        self._get_db_connection = index.get_db_connection
+    
+    @contextmanager
+    def get_db_connection(self) -> Iterator[Any]:
+        # Внутри shared_db_transaction соединение уже обёрнуто - не считаем запросы дважды
+        shared = getattr(index._db_local, 'shared_conn', None)
+        if shared is not None:
+            yield shared
+            return
+        self.connections += 1
+        with self._get_db_connection() as conn:
+            yield CountingConnection(conn, self)
+    
+    def __enter__(self) -> 'QueryCounter':
+        index.get_db_connection = self.get_db_connection
+        return self
+    
+    def __exit__(self, *exc_info):
+        index.get_db_connection = self._get_db_connection
+
+class CountingConnection:
+    def __init__(self, conn, counter: QueryCounter):
+        self._conn = conn
+        self._counter = counter
+    
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._conn.cursor(*args, **kwargs), self._counter)
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+class CountingCursor:
+    def __init__(self, cur, counter: QueryCounter):
+        self._cur = cur
+        self._counter = counter
+    
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cur.execute(*args, **kwargs)
+    
+    def __enter__(self) -> 'CountingCursor':
+        self._cur.__enter__()
+        return self
+    
+    def __exit__(self, *exc_info):
+        return self._cur.__exit__(*exc_info)
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cur, name)
+
+def reset_caches(chat_id: int, username: str):
+    index._manager_rank_cache.invalidate(username)
+    index._admin_level_cache.invalidate((chat_id, username))
+    index._chat_owner_cache.invalidate(chat_id)
+
+def legacy_profile(chat_id: int, username: str) -> Dict[str, Any]:
+    """Прежний путь /profile: отдельный запрос на каждое поле карточки"""
+    profile: Dict[str, Any] = {
+        'manager_rank': index.get_manager_rank(username),
+        'admin_level': index.get_chat_admin_level(chat_id, username),
+        'is_owner': index.is_chat_owner(chat_id, username),
+        'user_id': index.get_user_id_by_username(username)
+    }
+    if profile['user_id']:
+        profile['balance'] = index.get_user_balance(profile['user_id'], username)
+        profile['premium'] = index.get_user_premium(profile['user_id'])
+    return profile
+
+def single_query_profile(chat_id: int, username: str) -> Dict[str, Any]:
+    return index.get_profile(chat_id, username=username)
+
+def measure(name: str, read_profile: Callable[[int, str], Dict[str, Any]], chat_id: int, username: str,
+            iterations: int) -> Dict[str, Any]:
+    with QueryCounter() as counter:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            reset_caches(chat_id, username)
+            read_profile(chat_id, username)
+        elapsed = time.perf_counter() - started
+    return {
+        'path': name,
+        'iterations': iterations,
+        'queries_per_profile': counter.queries / iterations,
+        'connections_per_profile': counter.connections / iterations,
+        'ms_per_profile': round(elapsed / iterations * 1000, 3)
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compare database round trips of the legacy and single-query profile reads')
+    parser.add_argument('--chat-id', type=int, required=True, help='chat to read the chat role from')
+    parser.add_argument('--username', required=True, help='profile owner without @')
+    parser.add_argument('--iterations', type=int, default=200, help='profile reads per path')
+    args = parser.parse_args(argv)
+    
+    results = [
+        measure('legacy', legacy_profile, args.chat_id, args.username, args.iterations),
+        measure('single_query', single_query_profile, args.chat_id, args.username, args.iterations)
+    ]
+    for result in results:
+        print(json.dumps(result))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, Any, Optional, List
+
+# Модули, которые index.py откладывает до первого использования; их появление после импорта - регрессия
+DEFERRED_MODULES = ('psycopg2', 'http.client', 'concurrent.futures', 'traceback')
+STARTUP_BOT_TOKEN = '900000002:STARTUP'
+STARTUP_CHAT_ID = -1009100000000
+# Допустимый рост медианы относительно базовой линии; холодный старт шумнее горячего пути
+STARTUP_TOLERANCE = 0.3
+# На медиане в ~10 мс одни только 30% тонут в разбросе между запусками, поэтому допуск не меньше этого
+STARTUP_TOLERANCE_MS = 5.0
+
+def measure_cold_start() -> Dict[str, Any]:
+    """Выполняется в свежем интерпретаторе: импорт index и первые ответы handler()"""
+    modules_before = len(sys.modules)
+    started = time.perf_counter()
+    import index
+    imported = time.perf_counter()
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+    modules_at_import = len(sys.modules) - modules_before
+    index.handler({'httpMethod': 'OPTIONS'}, None)
+    options = time.perf_counter()
+    result = {
+        'import_ms': (imported - started) * 1000,
+        'first_options_ms': (options - started) * 1000,
+        'modules_at_import': modules_at_import,
+        'deferred_loaded_at_import': loaded
+    }
+    if os.environ.get('DATABASE_URL'):
+        os.environ['TELEGRAM_BOT_TOKEN'] = STARTUP_BOT_TOKEN
+        update = {
+            'update_id': time.time_ns() // 1000,
+            'message': {
+                'message_id': 1,
+                'from': {'id': 900000001, 'username': 'startup_bench', 'first_name': 'Startup'},
+                'chat': {'id': STARTUP_CHAT_ID, 'title': 'Startup bench', 'type': 'supergroup'},
+                'text': '/commands'
+            }
+        }
+        response = index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+        result['first_update_ms'] = (time.perf_counter() - started) * 1000
+        result['first_update_inline'] = json.loads(response['body']).get('method')
+    return result
+
+def run(runs: int) -> Dict[str, Any]:
+    """Запустить runs холодных стартов в отдельных процессах; медиана и максимум каждого замера"""
+    samples: List[Dict[str, Any]] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        sample['process_ms'] = (time.perf_counter() - started) * 1000
+        samples.append(sample)
+    
+    result: Dict[str, Any] = {'runs': runs}
+    for metric in ('import_ms', 'first_options_ms', 'first_update_ms', 'process_ms'):
+        values = [sample[metric] for sample in samples if metric in sample]
+        if values:
+            result[metric] = {'median': round(statistics.median(values), 3), 'max': round(max(values), 3)}
+    # Число модулей, загруженных импортом index, не зависит от шума и ловит новый тяжёлый импорт точнее времени
+    result['modules_at_import'] = max(sample['modules_at_import'] for sample in samples)
+    result['deferred_loaded_at_import'] = sorted({name for sample in samples for name in sample['deferred_loaded_at_import']})
+    return result
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = STARTUP_TOLERANCE,
+            tolerance_ms: float = STARTUP_TOLERANCE_MS) -> List[str]:
+    regressions = [f'{name} is imported at module import' for name in result['deferred_loaded_at_import']]
+    if 'modules_at_import' in baseline and result['modules_at_import'] > baseline['modules_at_import']:
+        regressions.append(f"modules_at_import: {result['modules_at_import']} > baseline {baseline['modules_at_import']}")
+    for metric in ('import_ms', 'first_options_ms', 'first_update_ms'):
+        if metric not in result or metric not in baseline:
+            continue
+        allowed = max(baseline[metric]['median'] * tolerance, tolerance_ms)
+        if result[metric]['median'] > baseline[metric]['median'] + allowed:
+            regressions.append(f"{metric}: median {result[metric]['median']} ms > baseline {baseline[metric]['median']} ms")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark cold start of the webhook function: import to first response')
+    parser.add_argument('--runs', type=int, default=10, help='cold starts to measure')
+    parser.add_argument('--output', metavar='PATH', help='save results as JSON, e.g. to record a new baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with a saved run and exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=STARTUP_TOLERANCE, help='allowed relative growth of medians over the baseline')
+    parser.add_argument('--tolerance-ms', type=float, default=STARTUP_TOLERANCE_MS, help='allowed growth of medians in ms when it exceeds the relative one')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    
+    if args.child:
+        print(json.dumps(measure_cold_start()))
+        return 0
+    
+    result = run(args.runs)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.tolerance_ms)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
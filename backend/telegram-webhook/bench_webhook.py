@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Any, Optional, List, Tuple
+
+import index
+from bench_profile import QueryCounter
+from fake_bot_api import FakeBotApi, FaultConfig
+
+BENCH_BOT_TOKEN = '900000001:BENCH'
+BENCH_CHAT_ID_BASE = -1009000000000
+BENCH_USER_ID_BASE = 900000000
+BENCH_BALANCE = 1000000
+# Доля обычной переписки и команд в синтетическом потоке, примерно как в живых чатах
+UPDATE_MIX = {
+    'chatter': 40,
+    '/farm': 12,
+    '/me': 12,
+    '/balance': 6,
+    '/commands': 4,
+    '/profile': 5,
+    '/mutelist': 3,
+    '/mute': 3,
+    'join': 3,
+    'callback:premium': 4,
+    'callback:list': 3,
+    'unknown_command': 5
+}
+# Допустимый рост p95 относительно базовой линии, прежде чем считать его регрессией
+P95_TOLERANCE = 0.25
+
+class UpdateFactory:
+    """Синтетические апдейты: участники чатов, владельцы и админы берутся из seed_database"""
+    
+    def __init__(self, chats: int, users: int, seed: int):
+        self.chats = chats
+        self.users = users
+        self.random = random.Random(seed)
+        self.update_id = int(time.time() * 1000)
+        self.message_id = 0
+    
+    def chat_id(self, number: int) -> int:
+        return BENCH_CHAT_ID_BASE - number
+    
+    def user(self, number: int) -> Dict[str, Any]:
+        return {'id': BENCH_USER_ID_BASE + number, 'username': f'bench_user_{number}', 'first_name': f'Bench {number}'}
+    
+    def message(self, chat: int, sender: int, text: str, **extra) -> Dict[str, Any]:
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'from': self.user(sender),
+            'chat': {'id': self.chat_id(chat), 'title': f'Bench chat {chat}', 'type': 'supergroup'},
+            'text': text
+        }
+        message.update(extra)
+        return message
+    
+    def make(self, kind: str) -> Dict[str, Any]:
+        chat = self.random.randrange(self.chats)
+        # Пользователь с номером chat - владелец своего чата, следующий за ним - админ 3 уровня
+        moderator = (chat + 1) % self.users
+        member = self.random.randrange(self.users)
+        update: Dict[str, Any]
+        if kind == 'chatter':
+            update = {'message': self.message(chat, member, self.random.choice(('привет', 'кто тут?', 'ок', 'го в войс')))}
+        elif kind == 'join':
+            update = {'message': self.message(chat, chat, '', new_chat_members=[self.user(member)])}
+        elif kind == '/mute':
+            target = self.user(member)
+            update = {'message': self.message(chat, moderator, '/mute 5', reply_to_message={'message_id': 1, 'from': target})}
+        elif kind == '/profile':
+            update = {'message': self.message(chat, member, f'/profile @bench_user_{self.random.randrange(self.users)}')}
+        elif kind == 'unknown_command':
+            update = {'message': self.message(chat, member, '/nosuchcommand')}
+        elif kind == '/mutelist':
+            update = {'message': self.message(chat, moderator, '/mutelist')}
+        elif kind == 'callback:premium':
+            self.message_id += 1
+            update = {'callback_query': {
+                'id': str(self.update_id),
+                'from': self.user(member),
+                'message': {'message_id': self.message_id, 'chat': {'id': self.chat_id(chat), 'type': 'supergroup'}},
+                'data': 'premium_3'
+            }}
+        elif kind == 'callback:list':
+            self.message_id += 1
+            update = {'callback_query': {
+                'id': str(self.update_id),
+                'from': self.user(moderator),
+                'message': {'message_id': self.message_id, 'chat': {'id': self.chat_id(chat), 'type': 'supergroup'}},
+                'data': 'list:mutes:'
+            }}
+        else:
+            update = {'message': self.message(chat, member, kind)}
+        self.update_id += 1
+        update['update_id'] = self.update_id
+        return update
+    
+    def stream(self, count: int) -> List[Tuple[str, Dict[str, Any]]]:
+        kinds = self.random.choices(list(UPDATE_MIX), weights=list(UPDATE_MIX.values()), k=count)
+        return [(kind, self.make(kind)) for kind in kinds]
+
+def seed_database(chats: int, users: int):
+    """Чаты с владельцами и админами, кошельки участников; повторный запуск только обновляет строки"""
+    with index.get_db_connection() as conn:
+        with conn.cursor() as cur:
+            for chat in range(chats):
+                chat_id = BENCH_CHAT_ID_BASE - chat
+                cur.execute(
+                    """INSERT INTO chats (chat_id, chat_title, owner_username) VALUES (%s, %s, %s)
+                       ON CONFLICT (chat_id) DO UPDATE SET chat_title = EXCLUDED.chat_title, owner_username = EXCLUDED.owner_username""",
+                    (chat_id, f'Bench chat {chat}', f'bench_user_{chat}')
+                )
+                cur.execute(
+                    """INSERT INTO chat_admins (chat_id, telegram_username, telegram_id, admin_level) VALUES (%s, %s, %s, 3)
+                       ON CONFLICT (chat_id, telegram_username) DO NOTHING""",
+                    (chat_id, f'bench_user_{(chat + 1) % users}', BENCH_USER_ID_BASE + (chat + 1) % users)
+                )
+            cur.execute(
+                """INSERT INTO user_currency (user_id, username, balance)
+                   SELECT %s + n, 'bench_user_' || n, %s FROM generate_series(0, %s - 1) AS n
+                   ON CONFLICT (user_id) DO UPDATE SET balance = EXCLUDED.balance, last_farm = NULL""",
+                (BENCH_USER_ID_BASE, BENCH_BALANCE, users)
+            )
+            cur.execute("DELETE FROM processed_updates WHERE bot_id = %s", (index.get_bot_id(BENCH_BOT_TOKEN),))
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples: List[float], queries: int, calls: int) -> Dict[str, Any]:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'queries_per_update': round(queries / len(samples), 2),
+        'telegram_calls_per_update': round(calls / len(samples), 2)
+    }
+
+def run(updates: int, warmup: int, chats: int, users: int, seed: int, faults: FaultConfig = FaultConfig()) -> Dict[str, Any]:
+    """Прогнать синтетический поток через handler(): пропускная способность, перцентили, запросы к БД и вызовы Bot API по типам апдейтов"""
+    os.environ['TELEGRAM_BOT_TOKEN'] = BENCH_BOT_TOKEN
+    # Лимиты Telegram в бенчмарке только искажали бы задержки ожиданием токенов
+    index.TELEGRAM_GLOBAL_RATE_PER_SECOND = index.TELEGRAM_GROUP_RATE_PER_MINUTE = index.TELEGRAM_CHAT_RATE_PER_SECOND = 1e9
+    seed_database(chats, users)
+    factory = UpdateFactory(chats, users, seed)
+    samples: Dict[str, List[float]] = defaultdict(list)
+    queries: Dict[str, int] = defaultdict(int)
+    calls: Dict[str, int] = defaultdict(int)
+    
+    with FakeBotApi(faults=faults, seed=seed) as api:
+        index._telegram_client = index.TelegramClient(BENCH_BOT_TOKEN, base_url=api.url, rate_limiter=index.RateLimiter())
+        for kind, update in factory.stream(warmup):
+            index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+        
+        stream = factory.stream(updates)
+        with QueryCounter() as counter:
+            started = time.perf_counter()
+            for kind, update in stream:
+                queries_before, calls_before = counter.queries, api.calls
+                update_started = time.perf_counter()
+                response = index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+                samples[kind].append(time.perf_counter() - update_started)
+                queries[kind] += counter.queries - queries_before
+                # Ответ, отданный в теле вебхука, - тоже вызов Bot API, только без отдельного запроса
+                inline_call = 'method' in json.loads(response['body'])
+                calls[kind] += api.calls - calls_before + inline_call
+            elapsed = time.perf_counter() - started
+        api_stats = api.stats()
+    
+    all_samples = [sample for kind_samples in samples.values() for sample in kind_samples]
+    return {
+        'updates': updates,
+        'seed': seed,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / elapsed, 1),
+        'overall': summarize(all_samples, sum(queries.values()), sum(calls.values())),
+        'types': {kind: summarize(samples[kind], queries[kind], calls[kind]) for kind in sorted(samples)},
+        'telegram_methods': api_stats['methods'],
+        'telegram_statuses': api_stats['statuses']
+    }
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = P95_TOLERANCE) -> List[str]:
+    """Регрессии относительно базовой линии: рост p95 сверх допуска, лишние запросы или вызовы Bot API"""
+    regressions = []
+    for kind, stats in result['types'].items():
+        base = baseline['types'].get(kind)
+        if base is None:
+            continue
+        if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{kind}: p95 {stats['p95_ms']} ms > baseline {base['p95_ms']} ms")
+        if stats['queries_per_update'] > base['queries_per_update']:
+            regressions.append(f"{kind}: {stats['queries_per_update']} queries per update > baseline {base['queries_per_update']}")
+        if stats['telegram_calls_per_update'] > base['telegram_calls_per_update']:
+            regressions.append(f"{kind}: {stats['telegram_calls_per_update']} Telegram calls per update > baseline {base['telegram_calls_per_update']}")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark handler() on a synthetic update mix against local Postgres and a fake Bot API')
+    parser.add_argument('--updates', type=int, default=2000, help='measured updates')
+    parser.add_argument('--warmup', type=int, default=200, help='updates sent before measuring')
+    parser.add_argument('--chats', type=int, default=20, help='seeded chats')
+    parser.add_argument('--users', type=int, default=200, help='seeded users')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the update mix')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='delay of every fake Bot API response')
+    parser.add_argument('--api-rate-429', type=float, default=0, help='share of Bot API calls answered with 429')
+    parser.add_argument('--api-rate-5xx', type=float, default=0, help='share of Bot API calls answered with 502')
+    parser.add_argument('--output', metavar='PATH', help='save results as JSON, e.g. to record a new baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with a saved run and exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=P95_TOLERANCE, help='allowed relative p95 growth over the baseline')
+    args = parser.parse_args(argv)
+    
+    if not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is not configured', file=sys.stderr)
+        return 1
+    
+    faults = FaultConfig(latency=args.api_latency_ms / 1000, too_many_requests_rate=args.api_rate_429, server_error_rate=args.api_rate_5xx)
+    result = run(args.updates, args.warmup, args.chats, args.users, args.seed, faults)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
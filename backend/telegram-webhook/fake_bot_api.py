@@ -0,0 +1,238 @@
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Optional, List, Callable, NamedTuple, Tuple
+from urllib.parse import parse_qsl
+
+from polling import load_replay_file
+
+FAKE_API_HOST = '127.0.0.1'
+FAKE_API_PORT = 8081
+FAKE_API_HISTORY_SIZE = 10000
+# getUpdates держит запрос не дольше этого, даже если клиент просит больший timeout
+FAKE_API_MAX_POLL_SECONDS = 5
+
+class RecordedCall(NamedTuple):
+    method: str
+    payload: Dict[str, Any]
+    status: int
+    at: float
+
+class FaultConfig(NamedTuple):
+    """Задержка ответа и доли ответов 429 и 5xx"""
+    latency: float = 0.0
+    jitter: float = 0.0
+    too_many_requests_rate: float = 0.0
+    retry_after: int = 1
+    server_error_rate: float = 0.0
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        super().setup()
+        # Без TCP_NODELAY ответ ждёт ACK на предыдущий сегмент и keep-alive запросы получают лишние ~40 мс
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def do_GET(self):
+        # Bot API принимает и GET с параметрами в query string, так вызывает getMe функция telegram-bot
+        path, _, query = self.path.partition('?')
+        self.reply(path, dict(parse_qsl(query)))
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            payload = {}
+        self.reply(self.path, payload)
+    
+    def reply(self, path: str, payload: Dict[str, Any]):
+        _, _, method = path.rpartition('/')
+        status, response = self.server.dispatch(path, method, payload)
+        self.send_json(status, response)
+    
+    def send_json(self, status: int, response: Dict[str, Any]):
+        raw = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+    
+    def log_message(self, *args):
+        pass
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Локальная замена Bot API для нагрузочных тестов: записывает вызовы, умеет задержки, 429 и 5xx; port=0 - любой свободный"""
+    
+    daemon_threads = True
+    
+    def __init__(self, host: str = FAKE_API_HOST, port: int = 0, faults: FaultConfig = FaultConfig(),
+                 seed: Optional[int] = None, history_size: int = FAKE_API_HISTORY_SIZE):
+        super().__init__((host, port), FakeBotApiHandler)
+        self.faults = faults
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.methods: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.history: deque = deque(maxlen=history_size)
+        self.webhook_url = ''
+        self._updates: List[Dict[str, Any]] = []
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._updates_added = threading.Condition(self._lock)
+        self._methods: Dict[str, Callable[[str, Dict[str, Any]], Any]] = {
+            'getMe': self.get_me,
+            'setWebhook': self.set_webhook,
+            'deleteWebhook': self.delete_webhook,
+            'getUpdates': self.get_updates,
+            'sendMessage': self.send_message,
+            'editMessageText': self.edit_message_text,
+            'deleteMessage': lambda token, payload: True,
+            'answerCallbackQuery': lambda token, payload: True,
+            'banChatMember': lambda token, payload: True,
+            'unbanChatMember': lambda token, payload: True,
+            'restrictChatMember': lambda token, payload: True,
+            'setChatTitle': lambda token, payload: True
+        }
+    
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+    
+    def add_updates(self, updates: List[Dict[str, Any]]):
+        """Положить апдейты в очередь getUpdates и разбудить ждущие long polling запросы"""
+        with self._updates_added:
+            self._updates.extend(updates)
+            self._updates_added.notify_all()
+    
+    def dispatch(self, path: str, method: str, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        token = path.split('/bot', 1)[-1].rsplit('/', 1)[0]
+        status, response = self.inject_faults()
+        if status == 200:
+            handle = self._methods.get(method)
+            if handle is None:
+                status, response = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+            else:
+                response = {'ok': True, 'result': handle(token, payload)}
+        with self._lock:
+            self.calls += 1
+            self.methods[method] += 1
+            self.statuses[status] += 1
+            self.history.append(RecordedCall(method, payload, status, time.time()))
+        return status, response
+    
+    def inject_faults(self) -> Tuple[int, Dict[str, Any]]:
+        faults = self.faults
+        with self._lock:
+            delay = faults.latency + self.random.uniform(0, faults.jitter) if faults.jitter else faults.latency
+            roll = self.random.random()
+        if delay:
+            time.sleep(delay)
+        if roll < faults.too_many_requests_rate:
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {faults.retry_after}',
+                'parameters': {'retry_after': faults.retry_after}
+            }
+        if roll < faults.too_many_requests_rate + faults.server_error_rate:
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+        return 200, {}
+    
+    def bot_user(self, token: str) -> Dict[str, Any]:
+        bot_id = token.split(':', 1)[0]
+        return {'id': int(bot_id) if bot_id.isdigit() else 0, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_bot'}
+    
+    def get_me(self, token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.bot_user(token)
+    
+    def set_webhook(self, token: str, payload: Dict[str, Any]) -> bool:
+        self.webhook_url = payload.get('url', '')
+        return True
+    
+    def delete_webhook(self, token: str, payload: Dict[str, Any]) -> bool:
+        self.webhook_url = ''
+        if payload.get('drop_pending_updates'):
+            with self._lock:
+                self._updates.clear()
+        return True
+    
+    def get_updates(self, token: str, payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = payload.get('offset', 0)
+        limit = payload.get('limit', 100)
+        deadline = time.monotonic() + min(payload.get('timeout', 0), FAKE_API_MAX_POLL_SECONDS)
+        with self._updates_added:
+            # Как и Telegram, подтверждённые через offset апдейты больше не отдаём
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_added.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+    
+    def make_message(self, token: str, payload: Dict[str, Any], message_id: Optional[int] = None) -> Dict[str, Any]:
+        if message_id is None:
+            with self._lock:
+                self._message_id += 1
+                message_id = self._message_id
+        return {
+            'message_id': message_id,
+            'from': self.bot_user(token),
+            'chat': {'id': payload.get('chat_id')},
+            'date': int(time.time()),
+            'text': payload.get('text', '')
+        }
+    
+    def send_message(self, token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.make_message(token, payload)
+    
+    def edit_message_text(self, token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.make_message(token, payload, payload.get('message_id'))
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'calls': self.calls, 'methods': dict(self.methods), 'statuses': dict(self.statuses)}
+    
+    def __enter__(self) -> 'FakeBotApi':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Local fake Telegram Bot API with latency and fault injection')
+    parser.add_argument('--host', default=FAKE_API_HOST, help='listen address')
+    parser.add_argument('--port', type=int, default=FAKE_API_PORT, help='listen port')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay before every response')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='extra random delay up to this value')
+    parser.add_argument('--rate-429', type=float, default=0, help='share of calls answered with 429 Too Many Requests')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after seconds in 429 responses')
+    parser.add_argument('--rate-5xx', type=float, default=0, help='share of calls answered with 502 Bad Gateway')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of fault injection')
+    parser.add_argument('--updates', metavar='PATH', help='JSON or JSON Lines file with updates served by getUpdates')
+    args = parser.parse_args(argv)
+    
+    faults = FaultConfig(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, args.retry_after, args.rate_5xx)
+    with FakeBotApi(args.host, args.port, faults, args.seed) as api:
+        if args.updates:
+            api.add_updates(load_replay_file(args.updates))
+        print(f'Fake Bot API listening on {api.url}, set TELEGRAM_API_URL={api.url}', file=sys.stderr)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps(api.stats()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
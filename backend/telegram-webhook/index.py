@@ -1,18 +1,415 @@
+import html
 import json
 import os
-from typing import Dict, Any, Optional, List
-import urllib.request
-import urllib.error
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import queue
+import sys
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterator, Callable, NamedTuple, Tuple, TYPE_CHECKING
 from datetime import datetime, timedelta
 import random
 
-def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn)
+if TYPE_CHECKING:
+    import http.client
+    from concurrent.futures import Future
+
+# Тяжёлые модули импортируются там, где они впервые нужны, чтобы не удлинять холодный старт:
+# psycopg2 - в get_db_pool, http.client - при первом HTTP-запросе к Bot API (ответы в теле вебхука
+# обходятся без него), concurrent.futures и traceback - в своих редких ветках
+psycopg2: Any = None
+RealDictCursor: Any = None
+
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', '1'))
+DB_POOL_MAX_CONN = int(os.environ.get('DB_POOL_MAX_CONN', '5'))
+DB_HEALTHCHECK_IDLE_SECONDS = 30
+ROLE_CACHE_TTL_SECONDS = float(os.environ.get('ROLE_CACHE_TTL_SECONDS', '60'))
+ROLE_CACHE_MAX_SIZE = int(os.environ.get('ROLE_CACHE_MAX_SIZE', '10000'))
+# Как часто тёплый экземпляр пишет в лог попадания кешей и ожидания лимитов Bot API
+CACHE_STATS_LOG_INTERVAL_SECONDS = float(os.environ.get('CACHE_STATS_LOG_INTERVAL_SECONDS', '300'))
+USER_DIRECTORY_CACHE_TTL_SECONDS = float(os.environ.get('USER_DIRECTORY_CACHE_TTL_SECONDS', '600'))
+# Telegram повторяет недоставленный апдейт в течение суток; столько же помним обработанные update_id
+PROCESSED_UPDATES_TTL_SECONDS = int(os.environ.get('PROCESSED_UPDATES_TTL_SECONDS', '86400'))
+PROCESSED_UPDATES_CACHE_SIZE = int(os.environ.get('PROCESSED_UPDATES_CACHE_SIZE', '10000'))
+# Незавершённую за это время отметку оставила убитая по таймауту функция: повтор апдейта может её перехватить
+PROCESSED_UPDATES_CLAIM_TIMEOUT_SECONDS = int(os.environ.get('PROCESSED_UPDATES_CLAIM_TIMEOUT_SECONDS', '120'))
+# Базовый URL Bot API; для нагрузочных тестов - адрес локальной заглушки fake_bot_api.py, например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '4'))
+TELEGRAM_TIMEOUT_SECONDS = 10
+WEBHOOK_INLINE_REPLY = os.environ.get('WEBHOOK_INLINE_REPLY', '1') == '1'
+# Дольше Telegram ответ вебхука не ждёт и тело ответа теряется, поэтому после этого срока ответ уходит через Bot API
+WEBHOOK_INLINE_REPLY_DEADLINE_SECONDS = float(os.environ.get('WEBHOOK_INLINE_REPLY_DEADLINE_SECONDS', '20'))
+# Вебхук только кладёт апдейт в update_queue, обработку выполняет worker.py
+WEBHOOK_DEFERRED = os.environ.get('WEBHOOK_DEFERRED', '0') == '1'
+# Методы, которые Telegram принимает в теле ответа на вебхук и чей результат нам не нужен
+INLINE_REPLY_METHODS = ('sendMessage', 'answerCallbackQuery', 'editMessageText')
+# Лимиты Telegram: ~30 сообщений в секунду на бота, 20 в минуту на группу, ~1 в секунду на личный чат
+TELEGRAM_GLOBAL_RATE_PER_SECOND = float(os.environ.get('TELEGRAM_GLOBAL_RATE_PER_SECOND', '30'))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.environ.get('TELEGRAM_GROUP_RATE_PER_MINUTE', '20'))
+TELEGRAM_CHAT_RATE_PER_SECOND = float(os.environ.get('TELEGRAM_CHAT_RATE_PER_SECOND', '1'))
+TELEGRAM_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get('TELEGRAM_RATE_LIMIT_MAX_WAIT_SECONDS', '5'))
+TELEGRAM_MAX_RETRIES = 2
+# Методы, которые публикуют сообщение в чат и расходуют лимит этого чата
+CHAT_RATE_LIMITED_METHODS = ('sendMessage', 'editMessageText')
+REPORTS_PAGE_SIZE = 10
+# Текст репорта на странице обрезается, чтобы страница из REPORTS_PAGE_SIZE репортов укладывалась в одно сообщение
+REPORT_PREVIEW_LENGTH = 300
+LIST_PAGE_SIZE = 20
+# Сколько строк читать за раз при выгрузке списка целиком
+LIST_DUMP_BATCH_SIZE = 200
+# Выгрузка идёт синхронно и упирается в лимит чата (~20 сообщений в минуту), поэтому больше этого - только постранично
+LIST_DUMP_MAX_MESSAGES = int(os.environ.get('LIST_DUMP_MAX_MESSAGES', '5'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+BATCH_COMMIT_SIZE = int(os.environ.get('BATCH_COMMIT_SIZE', '100'))
+# Пакетная обработка: чаты раскладываются по шардам, каждый шард - поток со своей транзакцией и соединением.
+# Каждому шарду нужно соединение из пула, поэтому шардов не больше DB_POOL_MAX_CONN - 1
+UPDATE_SHARDS = max(1, min(int(os.environ.get('UPDATE_SHARDS', '4')), DB_POOL_MAX_CONN - 1))
+# Меньше пачки getUpdates (100): пачка, где почти всё из одного чата, упирается в очередь шарда и submit ждёт
+UPDATE_SHARD_QUEUE_SIZE = int(os.environ.get('UPDATE_SHARD_QUEUE_SIZE', '50'))
+# Шард коммитит чаще, чем последовательная обработка, чтобы меньше держать блокировки строк, общие с другими шардами
+UPDATE_SHARD_COMMIT_SIZE = int(os.environ.get('UPDATE_SHARD_COMMIT_SIZE', '20'))
+# Команды, для которых при пакетной обработке заранее создаётся строка user_currency
+WALLET_COMMANDS = ('/me', '/balance', '/farm', '/premium')
+# Спаны запросов к БД и вызовов Bot API, одна строка лога 'trace' на вызов функции
+WEBHOOK_TRACE = os.environ.get('WEBHOOK_TRACE', '0') == '1'
+# Сколько спанов попадает в строку лога; суммы считаются по всем
+TRACE_MAX_SPANS = 100
+# Доля вызовов, выполняемых под cProfile; отдельный вызов можно профилировать заголовком X-Profile-Token
+WEBHOOK_PROFILE_RATE = float(os.environ.get('WEBHOOK_PROFILE_RATE', '0'))
+WEBHOOK_PROFILE_TOKEN = os.environ.get('WEBHOOK_PROFILE_TOKEN', '')
+# Каталог для .prof файлов (смотреть через python -m pstats или snakeviz); пусто - только строка лога
+WEBHOOK_PROFILE_DIR = os.environ.get('WEBHOOK_PROFILE_DIR', '')
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '20'))
+# Группы функций, собственное время которых суммируется в строке лога 'profile'
+PROFILE_GROUPS = (
+    ('psycopg2', ('psycopg2',)),
+    ('json', ('json',)),
+    ('http', ('http/client', 'socket', 'ssl'))
+)
+
+# Пул живёт на уровне модуля и переиспользуется между тёплыми вызовами функции
+_db_pool: Optional['psycopg2.pool.ThreadedConnectionPool'] = None
+_db_conn_last_used: Dict[int, float] = {}
+_db_pool_lock = threading.Lock()
+# Общее соединение пакетной обработки, см. shared_db_transaction
+_db_local = threading.local()
+
+class Trace:
+    """Спаны одного вызова функции: запросы к БД и вызовы Bot API с длительностью и результатом"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped_spans = 0
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.db_connections = 0
+        self.db_connections_opened = 0
+        self.api_seconds = 0.0
+        self.api_calls = 0
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+    
+    def add_span(self, kind: str, name: str, seconds: float, **fields: Any):
+        # Вызовы Bot API из call_concurrently и пайплайна приходят из других потоков
+        with self._lock:
+            if kind == 'api':
+                self.api_seconds += seconds
+                self.api_calls += 1
+            else:
+                self.db_seconds += seconds
+                self.db_queries += kind == 'db'
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append({'name': f'{kind}:{name}', 'ms': round(seconds * 1000, 3), **fields})
+            else:
+                self.dropped_spans += 1
+    
+    def add_connection(self, opened: bool, seconds: float):
+        with self._lock:
+            self.db_connections += 1
+            self.db_connections_opened += opened
+            if not opened:
+                self.db_seconds += seconds
+        if opened:
+            self.add_span('pool', 'connect', seconds)
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'db_ms': round(self.db_seconds * 1000, 3),
+            'db_queries': self.db_queries,
+            'db_connections': self.db_connections,
+            'db_connections_opened': self.db_connections_opened,
+            'api_ms': round(self.api_seconds * 1000, 3),
+            'api_calls': self.api_calls,
+            'error': self.error,
+            'spans': self.spans,
+            'dropped_spans': self.dropped_spans
+        }
+
+# Трассировка текущего вызова функции; None - трассировка выключена и обёртки не создаются
+_trace: Optional[Trace] = None
+
+class TracedCursor:
+    """Курсор, который пишет спан на каждый execute: имя - функция, выполнившая запрос"""
+    
+    def __init__(self, cur, trace: Trace):
+        self._cur = cur
+        self._trace = trace
+    
+    def execute(self, query: Any, vars: Any = None):
+        caller = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            self._cur.execute(query, vars)
+        except Exception as e:
+            self._trace.add_span('db', caller, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        self._trace.add_span('db', caller, time.perf_counter() - started, rows=self._cur.rowcount)
+    
+    def __enter__(self) -> 'TracedCursor':
+        self._cur.__enter__()
+        return self
+    
+    def __exit__(self, *exc_info):
+        return self._cur.__exit__(*exc_info)
+    
+    def __iter__(self):
+        return iter(self._cur)
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cur, name)
+
+class TracedConnection:
+    def __init__(self, conn, trace: Trace):
+        self._conn = conn
+        self._trace = trace
+    
+    def cursor(self, *args, **kwargs) -> TracedCursor:
+        return TracedCursor(self._conn.cursor(*args, **kwargs), self._trace)
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+def start_trace() -> Trace:
+    global _trace
+    _trace = Trace()
+    return _trace
+
+def finish_trace(trace: Trace, update: Dict[str, Any], response: Optional[Dict[str, Any]]):
+    global _trace
+    _trace = None
+    log_event('trace', update_id=update.get('update_id'), label=describe_update(update),
+              inline_reply=(response or {}).get('method'), **trace.summary())
+
+def load_psycopg2():
+    global psycopg2, RealDictCursor
+    import psycopg2.extras
+    import psycopg2.pool
+    RealDictCursor = psycopg2.extras.RealDictCursor
+
+def get_db_pool() -> 'psycopg2.pool.ThreadedConnectionPool':
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.closed:
+            if psycopg2 is None:
+                load_psycopg2()
+            dsn = os.environ.get('DATABASE_URL')
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, dsn)
+        return _db_pool
+
+def is_connection_healthy(conn) -> bool:
+    """Проверить соединение из пула; долго простаивавшие пингуются через SELECT 1"""
+    if conn.closed:
+        return False
+    last_used = _db_conn_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_db_connection(conn, broken: bool = False):
+    discard = broken or bool(conn.closed)
+    if discard:
+        _db_conn_last_used.pop(id(conn), None)
+    else:
+        _db_conn_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=discard)
+
+@contextmanager
+def get_db_connection() -> Iterator[Any]:
+    """Взять соединение из пула: commit при успехе, rollback при ошибке, затем вернуть в пул"""
+    shared = getattr(_db_local, 'shared_conn', None)
+    if shared is not None:
+        yield shared
+        return
+    trace = _trace
+    started = time.perf_counter()
+    db_pool = get_db_pool()
+    # Простаивающих соединений в пуле не больше DB_POOL_MAX_CONN: после стольких отброшенных getconn откроет новое
+    for _ in range(DB_POOL_MAX_CONN):
+        conn = db_pool.getconn()
+        if is_connection_healthy(conn):
+            break
+        release_db_connection(conn, broken=True)
+    else:
+        conn = db_pool.getconn()
+    if trace is not None:
+        # Соединение, которое ещё ни разу не возвращалось в пул, только что открыто
+        trace.add_connection(id(conn) not in _db_conn_last_used, time.perf_counter() - started)
+    broken = False
+    try:
+        with conn:
+            yield conn if trace is None else TracedConnection(conn, trace)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, broken)
+
+def purchase_premium(user_id: int, username: str, days: int, cost: int) -> Dict[str, Any]:
+    """Списать стоимость и продлить Premium одним оператором; списание только при достаточном балансе"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """WITH debit AS (
+                       UPDATE user_currency
+                       SET balance = balance - %(cost)s, username = %(username)s, updated_at = CURRENT_TIMESTAMP
+                       WHERE user_id = %(user_id)s AND balance >= %(cost)s
+                       RETURNING balance
+                   ), premium AS (
+                       INSERT INTO user_premium (user_id, username, expires_at)
+                       SELECT %(user_id)s, %(username)s, CURRENT_TIMESTAMP + make_interval(days => %(days)s) FROM debit
+                       ON CONFLICT (user_id)
+                       DO UPDATE SET expires_at = GREATEST(user_premium.expires_at, CURRENT_TIMESTAMP) + make_interval(days => %(days)s), username = EXCLUDED.username
+                       RETURNING expires_at
+                   )
+                   SELECT TRUE AS purchased, debit.balance, premium.expires_at FROM debit, premium
+                   UNION ALL
+                   SELECT FALSE, COALESCE((SELECT balance FROM user_currency WHERE user_id = %(user_id)s), 0), NULL
+                   WHERE NOT EXISTS (SELECT 1 FROM debit)""",
+                {'user_id': user_id, 'username': username, 'days': days, 'cost': cost}
+            )
+            return dict(cur.fetchone())
+
+class SharedConnection:
+    """Соединение пачки апдейтов: commit из обработчиков откладывается до конца пачки"""
+    
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def commit(self):
+        pass
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+@contextmanager
+def shared_db_transaction() -> Iterator[Any]:
+    """Все get_db_connection() внутри блока работают в одной транзакции на одном соединении"""
+    pending: List[tuple] = []
+    try:
+        with get_db_connection() as conn:
+            _db_local.shared_conn = SharedConnection(conn)
+            _db_local.pending_invalidations = pending
+            try:
+                yield conn
+            finally:
+                _db_local.shared_conn = None
+                _db_local.pending_invalidations = None
+    finally:
+        for cache, key in pending:
+            cache.invalidate(key)
+
+_CACHE_MISS = object()
+
+def invalidate_after_commit(cache: 'TTLCache', key: Any):
+    """Сбросить запись кеша; внутри shared_db_transaction ещё раз после коммита пачки, чтобы соседний шард не закешировал старое значение"""
+    cache.invalidate(key)
+    pending = getattr(_db_local, 'pending_invalidations', None)
+    if pending is not None:
+        pending.append((cache, key))
+
+class TTLCache:
+    """Ограниченный LRU-кеш с временем жизни записей и счётчиками попаданий"""
+    
+    def __init__(self, name: str, ttl: float, max_size: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _CACHE_MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key: Any, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, key: Any):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+# Ранги меняются только через /agent, /unagent, /szamrang, /rang, /unrang и вход бота в чат,
+# эти команды сразу сбрасывают соответствующую запись
+_manager_rank_cache = TTLCache('manager_rank', ROLE_CACHE_TTL_SECONDS, ROLE_CACHE_MAX_SIZE)
+_admin_level_cache = TTLCache('admin_level', ROLE_CACHE_TTL_SECONDS, ROLE_CACHE_MAX_SIZE)
+_chat_owner_cache = TTLCache('chat_owner', ROLE_CACHE_TTL_SECONDS, ROLE_CACHE_MAX_SIZE)
+# user_id -> (username, first_name), уже записанные в справочник users
+_user_directory_cache = TTLCache('user_directory', USER_DIRECTORY_CACHE_TTL_SECONDS, ROLE_CACHE_MAX_SIZE)
+# (bot_id, update_id) апдейтов, уже обработанных этим экземпляром функции
+_processed_updates_cache = TTLCache('processed_updates', PROCESSED_UPDATES_TTL_SECONDS, PROCESSED_UPDATES_CACHE_SIZE)
+
+def get_cache_stats() -> Dict[str, Any]:
+    caches = (_manager_rank_cache, _admin_level_cache, _chat_owner_cache, _user_directory_cache, _processed_updates_cache)
+    return {cache.name: cache.stats() for cache in caches}
+
+_cache_stats_logged_at = time.monotonic()
+
+def log_cache_stats():
+    """Не чаще раза в CACHE_STATS_LOG_INTERVAL_SECONDS записать в лог статистику кешей и лимитера Bot API"""
+    global _cache_stats_logged_at
+    now = time.monotonic()
+    if now - _cache_stats_logged_at < CACHE_STATS_LOG_INTERVAL_SECONDS:
+        return
+    _cache_stats_logged_at = now
+    log_event('cache_stats', cache=get_cache_stats(), telegram=_rate_limiter.stats())
 
 def get_manager_rank(username: str) -> Optional[str]:
+    cached = _manager_rank_cache.get(username)
+    if cached is not _CACHE_MISS:
+        return cached
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
@@ -20,9 +417,14 @@ def get_manager_rank(username: str) -> Optional[str]:
                 (username,)
             )
             result = cur.fetchone()
-            return result['manager_rank'] if result else None
+            rank = result['manager_rank'] if result else None
+    _manager_rank_cache.set(username, rank)
+    return rank
 
 def get_chat_admin_level(chat_id: int, username: str) -> Optional[int]:
+    cached = _admin_level_cache.get((chat_id, username))
+    if cached is not _CACHE_MISS:
+        return cached
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
@@ -30,9 +432,14 @@ def get_chat_admin_level(chat_id: int, username: str) -> Optional[int]:
                 (chat_id, username)
             )
             result = cur.fetchone()
-            return result['admin_level'] if result else None
+            level = result['admin_level'] if result else None
+    _admin_level_cache.set((chat_id, username), level)
+    return level
 
-def is_chat_owner(chat_id: int, username: str) -> bool:
+def get_chat_owner(chat_id: int) -> Optional[str]:
+    cached = _chat_owner_cache.get(chat_id)
+    if cached is not _CACHE_MISS:
+        return cached
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
@@ -40,7 +447,13 @@ def is_chat_owner(chat_id: int, username: str) -> bool:
                 (chat_id,)
             )
             result = cur.fetchone()
-            return result and result['owner_username'] == username
+            owner = result['owner_username'] if result else None
+    _chat_owner_cache.set(chat_id, owner)
+    return owner
+
+def is_chat_owner(chat_id: int, username: str) -> bool:
+    owner = get_chat_owner(chat_id)
+    return owner is not None and owner == username
 
 def get_user_balance(user_id: int, username: str) -> int:
     with get_db_connection() as conn:
@@ -81,144 +494,610 @@ def get_user_premium(user_id: int) -> Optional[datetime]:
             result = cur.fetchone()
             return result['expires_at'] if result else None
 
-def add_user_premium(user_id: int, username: str, days: int):
+def get_profile(chat_id: int, user_id: Optional[int] = None, username: Optional[str] = None) -> Dict[str, Any]:
+    """Карточка профиля одним запросом: id (если передан только юзернейм), ранги, баланс и Premium"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """WITH target AS (
+                       SELECT COALESCE(
+                           %(user_id)s::bigint,
+                           (SELECT user_id FROM users WHERE LOWER(username) = LOWER(%(username)s)),
+                           (SELECT telegram_id FROM bot_managers WHERE telegram_username = %(username)s AND telegram_id IS NOT NULL)
+                       ) AS user_id
+                   )
+                   SELECT
+                     target.user_id,
+                     (SELECT manager_rank FROM bot_managers WHERE telegram_username = %(username)s) AS manager_rank,
+                     (SELECT admin_level FROM chat_admins WHERE chat_id = %(chat_id)s AND telegram_username = %(username)s) AS admin_level,
+                     (SELECT owner_username FROM chats WHERE chat_id = %(chat_id)s) AS chat_owner,
+                     COALESCE((SELECT balance FROM user_currency WHERE user_id = target.user_id), 0) AS balance,
+                     (SELECT expires_at FROM user_premium WHERE user_id = target.user_id AND expires_at > CURRENT_TIMESTAMP) AS premium
+                   FROM target""",
+                {'chat_id': chat_id, 'user_id': user_id, 'username': username}
+            )
+            profile = dict(cur.fetchone())
+    _manager_rank_cache.set(username, profile['manager_rank'])
+    _admin_level_cache.set((chat_id, username), profile['admin_level'])
+    _chat_owner_cache.set(chat_id, profile['chat_owner'])
+    profile['is_owner'] = profile['chat_owner'] is not None and profile['chat_owner'] == username
+    return profile
+
+def save_chat_ban(chat_id: int, user_id: int, username: str, banned_until: Optional[datetime]):
+    """Записать бан в чате; banned_until = None - бан навсегда"""
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                """INSERT INTO user_premium (user_id, username, expires_at)
-                   VALUES (%s, %s, CURRENT_TIMESTAMP + INTERVAL '%s days')
-                   ON CONFLICT (user_id)
-                   DO UPDATE SET expires_at = GREATEST(user_premium.expires_at, CURRENT_TIMESTAMP) + INTERVAL '%s days', username = %s""",
-                (user_id, username, days, days, username)
+                """INSERT INTO chat_bans (chat_id, user_id, username, banned_until) VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (chat_id, user_id) DO UPDATE SET username = EXCLUDED.username, banned_until = EXCLUDED.banned_until""",
+                (chat_id, user_id, username, banned_until)
+            )
+            conn.commit()
+
+def delete_chat_ban(chat_id: int, user_id: int):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chat_bans WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+            conn.commit()
+
+def save_chat_mute(chat_id: int, user_id: int, username: str, muted_until: datetime):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO chat_mutes (chat_id, user_id, username, muted_until) VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (chat_id, user_id) DO UPDATE SET username = EXCLUDED.username, muted_until = EXCLUDED.muted_until""",
+                (chat_id, user_id, username, muted_until)
             )
             conn.commit()
 
+def delete_chat_mute(chat_id: int, user_id: int):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chat_mutes WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+            conn.commit()
+
+_KEY_EPOCH = datetime(1970, 1, 1)
+
+def encode_timestamp_key(value: Optional[datetime]) -> str:
+    """Время для ключа в callback_data: микросекунды от эпохи, None - 'inf' (бессрочно)"""
+    if value is None:
+        return 'inf'
+    return str((value - _KEY_EPOCH) // timedelta(microseconds=1))
+
+def decode_timestamp_key(value: str) -> Any:
+    if value == 'inf':
+        return 'infinity'
+    return _KEY_EPOCH + timedelta(microseconds=int(value))
+
+def get_active_chat_mutes(chat_id: int, after: Optional[str] = None, limit: int = LIST_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """Действующие муты чата по ключу (muted_until, user_id); читается диапазоном из idx_chat_mutes_chat_until"""
+    condition = ""
+    params: Dict[str, Any] = {'chat_id': chat_id, 'limit': limit}
+    if after:
+        until_key, user_id = after.split(':')
+        condition = "AND (muted_until, user_id) > (%(until)s, %(user_id)s)"
+        params.update(until=decode_timestamp_key(until_key), user_id=int(user_id))
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"""SELECT user_id, username, muted_until FROM chat_mutes
+                    WHERE chat_id = %(chat_id)s AND muted_until > CURRENT_TIMESTAMP {condition}
+                    ORDER BY muted_until, user_id
+                    LIMIT %(limit)s""",
+                params
+            )
+            return cur.fetchall()
+
+def get_active_chat_bans(chat_id: int, after: Optional[str] = None, limit: int = LIST_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """Действующие баны чата: временные по сроку окончания, затем постоянные; читается из idx_chat_bans_chat_until"""
+    condition = ""
+    params: Dict[str, Any] = {'chat_id': chat_id, 'limit': limit}
+    if after:
+        until_key, user_id = after.split(':')
+        condition = "AND (COALESCE(banned_until, 'infinity'), user_id) > (%(until)s::timestamp, %(user_id)s)"
+        params.update(until=decode_timestamp_key(until_key), user_id=int(user_id))
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"""SELECT user_id, username, banned_until FROM chat_bans
+                    WHERE chat_id = %(chat_id)s AND COALESCE(banned_until, 'infinity') > CURRENT_TIMESTAMP {condition}
+                    ORDER BY COALESCE(banned_until, 'infinity'), user_id
+                    LIMIT %(limit)s""",
+                params
+            )
+            return cur.fetchall()
+
+_NOT_LOADED = object()
+
+class CallerContext:
+    """Права и кошелёк автора апдейта: ранги берутся из кеша, остальное одним запросом при первом обращении"""
+    
+    def __init__(self, chat_id: int, user_id: int, username: str):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.username = username
+        self._row: Any = _NOT_LOADED
+        self._cached_values: Dict[str, Any] = {}
+    
+    def _load(self) -> Dict[str, Any]:
+        if self._row is _NOT_LOADED:
+            with get_db_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(
+                        """SELECT
+                             (SELECT manager_rank FROM bot_managers WHERE telegram_username = %(username)s) AS manager_rank,
+                             (SELECT admin_level FROM chat_admins WHERE chat_id = %(chat_id)s AND telegram_username = %(username)s) AS admin_level,
+                             (SELECT owner_username FROM chats WHERE chat_id = %(chat_id)s) AS chat_owner,
+                             EXISTS (SELECT 1 FROM server_bans WHERE telegram_username = %(username)s) AS is_server_banned,
+                             (SELECT balance FROM user_currency WHERE user_id = %(user_id)s) AS balance,
+                             (SELECT expires_at FROM user_premium WHERE user_id = %(user_id)s AND expires_at > CURRENT_TIMESTAMP) AS premium""",
+                        {'chat_id': self.chat_id, 'user_id': self.user_id, 'username': self.username}
+                    )
+                    self._row = dict(cur.fetchone())
+            _manager_rank_cache.set(self.username, self._row['manager_rank'])
+            _admin_level_cache.set((self.chat_id, self.username), self._row['admin_level'])
+            _chat_owner_cache.set(self.chat_id, self._row['chat_owner'])
+        return self._row
+    
+    def _cached(self, cache: TTLCache, key: Any, field: str) -> Any:
+        if self._row is not _NOT_LOADED:
+            return self._row[field]
+        if field not in self._cached_values:
+            cached = cache.get(key)
+            if cached is _CACHE_MISS:
+                return self._load()[field]
+            self._cached_values[field] = cached
+        return self._cached_values[field]
+    
+    @property
+    def manager_rank(self) -> Optional[str]:
+        return self._cached(_manager_rank_cache, self.username, 'manager_rank')
+    
+    @property
+    def admin_level(self) -> Optional[int]:
+        return self._cached(_admin_level_cache, (self.chat_id, self.username), 'admin_level')
+    
+    @property
+    def is_owner(self) -> bool:
+        owner = self._cached(_chat_owner_cache, self.chat_id, 'chat_owner')
+        return owner is not None and owner == self.username
+    
+    @property
+    def is_server_banned(self) -> bool:
+        return self._load()['is_server_banned']
+    
+    @property
+    def balance(self) -> int:
+        row = self._load()
+        if row['balance'] is None:
+            row['balance'] = get_user_balance(self.user_id, self.username)
+        return row['balance']
+    
+    @property
+    def premium(self) -> Optional[datetime]:
+        return self._load()['premium']
+
+class TokenBucket:
+    """Ведро токенов; может уходить в минус, тогда следующий вызов ждёт своей очереди"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def reserve(self, now: float) -> float:
+        """Забрать токен и вернуть, сколько секунд нужно подождать перед вызовом"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+    
+    def refund(self):
+        self.tokens += 1
+
+class RateLimiter:
+    """Общий лимит бота плюс лимиты по чатам, с учётом retry_after из ответов 429"""
+    
+    def __init__(self, max_chats: int = 10000):
+        self.max_chats = max_chats
+        self.max_wait = TELEGRAM_RATE_LIMIT_MAX_WAIT_SECONDS
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE_PER_SECOND, TELEGRAM_GLOBAL_RATE_PER_SECOND)
+        self.chat_buckets: OrderedDict = OrderedDict()
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.dropped = 0
+        self.too_many_requests = 0
+        self._lock = threading.Lock()
+    
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            if is_private:
+                bucket = TokenBucket(TELEGRAM_CHAT_RATE_PER_SECOND, 3)
+            else:
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE_PER_MINUTE / 60, TELEGRAM_GROUP_RATE_PER_MINUTE)
+            self.chat_buckets[chat_id] = bucket
+            while len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    def acquire(self, method: str, chat_id: Any = None) -> bool:
+        """Дождаться своей очереди; False - ждать дольше max_wait, вызов отброшен"""
+        with self._lock:
+            now = time.monotonic()
+            buckets = [self.global_bucket]
+            blocked_until = self.global_bucket.blocked_until
+            if chat_id is not None:
+                chat_bucket = self._chat_bucket(chat_id)
+                blocked_until = max(blocked_until, chat_bucket.blocked_until)
+                if method in CHAT_RATE_LIMITED_METHODS:
+                    buckets.append(chat_bucket)
+            wait = max([bucket.reserve(now) for bucket in buckets] + [blocked_until - now])
+            if wait > self.max_wait:
+                for bucket in buckets:
+                    bucket.refund()
+                self.dropped += 1
+                return False
+            if wait > 0:
+                self.throttled += 1
+                self.throttled_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+        return True
+    
+    def block(self, chat_id: Any, retry_after: float):
+        with self._lock:
+            self.too_many_requests += 1
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'throttled': self.throttled,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'dropped': self.dropped,
+            'too_many_requests': self.too_many_requests
+        }
+
+_rate_limiter = RateLimiter()
+
+class SendPipeline:
+    """Фоновая отправка ответов: вызовы в один чат идут строго по порядку, разные чаты - параллельно"""
+    
+    def __init__(self, client: 'TelegramClient', workers: int):
+        self._client = client
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._tails: Dict[Any, 'Future'] = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, method: str, payload: Dict[str, Any]):
+        chat_id = payload.get('chat_id')
+        with self._lock:
+            previous = self._tails.get(chat_id)
+            self._tails[chat_id] = self._executor.submit(self._run, previous, method, payload)
+    
+    def _run(self, previous: Optional['Future'], method: str, payload: Dict[str, Any]):
+        if previous is not None:
+            previous.exception()
+        self._client._send(method, payload)
+    
+    def drain(self):
+        # Каждая задача ждёт предыдущую в своём чате, поэтому достаточно дождаться последних
+        with self._lock:
+            tails = list(self._tails.values())
+            self._tails.clear()
+        for future in tails:
+            future.exception()
+    
+    def close(self):
+        self.drain()
+        self._executor.shutdown()
+
+class TelegramClient:
+    """Клиент Bot API с пулом keep-alive соединений, переживающим тёплые вызовы"""
+    
+    def __init__(self, bot_token: str, base_url: str = TELEGRAM_API_URL, pool_size: int = TELEGRAM_POOL_SIZE,
+                 rate_limiter: Optional[RateLimiter] = None, timeout: float = TELEGRAM_TIMEOUT_SECONDS):
+        from urllib.parse import urlsplit
+        self.bot_token = bot_token
+        url = urlsplit(base_url)
+        self.secure = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path_prefix = url.path.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or _rate_limiter
+        self._idle: List['http.client.HTTPConnection'] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def _acquire(self) -> tuple:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+    
+    def _connect(self) -> 'http.client.HTTPConnection':
+        import http.client
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+    
+    def _release(self, conn: 'http.client.HTTPConnection'):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+    
+    def _request(self, conn: 'http.client.HTTPConnection', method: str, body: bytes) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            conn.request(
+                'POST',
+                f'{self.path_prefix}/bot{self.bot_token}/{method}',
+                body=body,
+                headers={'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+            )
+            response = conn.getresponse()
+            raw = response.read()
+        except Exception as e:
+            if _trace is not None:
+                _trace.add_span('api', method, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        if _trace is not None:
+            _trace.add_span('api', method, time.perf_counter() - started, status=response.status)
+        if response.will_close:
+            conn.close()
+        return json.loads(raw.decode('utf-8'))
+    
+    def call(self, method: str, payload: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Вызвать любой метод Bot API; возвращает ответ Telegram или None при сетевой ошибке"""
+        replies = getattr(self._local, 'replies', None)
+        if replies is not None:
+            if method in INLINE_REPLY_METHODS:
+                replies.append((method, payload or {}))
+                return None
+            # Сохраняем порядок: отложенные ответы уходят раньше следующего вызова
+            self._flush(replies)
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None:
+            if method in INLINE_REPLY_METHODS:
+                pipeline.submit(method, payload or {})
+                return None
+            pipeline.drain()
+        return self._send(method, payload)
+    
+    @contextmanager
+    def pipeline(self, workers: Optional[int] = None) -> Iterator[SendPipeline]:
+        """Отправлять ответы в фоне, пока обрабатываются следующие апдейты"""
+        pipeline = SendPipeline(self, workers or self.pool_size)
+        self._local.pipeline = pipeline
+        try:
+            yield pipeline
+        finally:
+            self._local.pipeline = None
+            pipeline.close()
+    
+    @contextmanager
+    def collect_replies(self) -> Iterator[List[tuple]]:
+        """Отложить ответные вызовы до конца обработки апдейта"""
+        replies: List[tuple] = []
+        self._local.replies = replies
+        try:
+            yield replies
+        except BaseException:
+            self._local.replies = None
+            self._flush(replies)
+            raise
+        self._local.replies = None
+    
+    def send_replies(self, replies: List[tuple]):
+        """Отправить отложенные ответные вызовы обычными запросами"""
+        self._flush(replies)
+    
+    def take_inline_reply(self, replies: List[tuple]) -> Optional[Dict[str, Any]]:
+        """Вернуть последний ответный вызов для тела ответа вебхука, предыдущие отправить как обычно"""
+        if not replies:
+            return None
+        method, payload = replies.pop()
+        self._flush(replies)
+        if not self.rate_limiter.acquire(method, payload.get('chat_id')):
+            return None
+        return {'method': method, **payload}
+    
+    def call_concurrently(self, calls: List[tuple]) -> List[Optional[Dict[str, Any]]]:
+        """Выполнить независимые вызовы параллельно; в режиме отложенных ответов они просто ставятся в очередь"""
+        if getattr(self._local, 'replies', None) is not None or getattr(self._local, 'pipeline', None) is not None:
+            return [self.call(method, payload) for method, payload in calls]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            return list(executor.map(lambda call: self.call(*call), calls))
+    
+    def _flush(self, replies: List[tuple]):
+        while replies:
+            method, payload = replies.pop(0)
+            self._send(method, payload)
+    
+    def _send(self, method: str, payload: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        body = json.dumps(payload or {}).encode('utf-8')
+        chat_id = (payload or {}).get('chat_id')
+        result = None
+        for _ in range(TELEGRAM_MAX_RETRIES + 1):
+            if not self.rate_limiter.acquire(method, chat_id):
+                return None
+            result = self._post(method, body)
+            if not result or result.get('error_code') != 429:
+                return result
+            retry_after = result.get('parameters', {}).get('retry_after', 1)
+            self.rate_limiter.block(chat_id, retry_after)
+        return result
+    
+    def _post(self, method: str, body: bytes) -> Optional[Dict[str, Any]]:
+        import http.client
+        conn, reused = self._acquire()
+        try:
+            result = self._request(conn, method, body)
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            # Сервер мог закрыть простаивавшее keep-alive соединение - повторяем один раз на новом
+            if not reused:
+                return None
+            conn, reused = self._connect(), False
+            try:
+                result = self._request(conn, method, body)
+            except Exception:
+                conn.close()
+                return None
+        except Exception:
+            conn.close()
+            return None
+        self._release(conn)
+        return result
+
+_telegram_client: Optional[TelegramClient] = None
+
+def get_telegram_client(bot_token: str) -> TelegramClient:
+    global _telegram_client
+    if _telegram_client is None or _telegram_client.bot_token != bot_token:
+        _telegram_client = TelegramClient(bot_token)
+    return _telegram_client
+
 def send_telegram_message(bot_token: str, chat_id: int, text: str, reply_markup: Optional[Dict] = None):
-    url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
     payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
     if reply_markup:
         payload['reply_markup'] = reply_markup
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    return get_telegram_client(bot_token).call('sendMessage', payload)
 
 def delete_telegram_message(bot_token: str, chat_id: int, message_id: int):
-    url = f'https://api.telegram.org/bot{bot_token}/deleteMessage'
-    data = json.dumps({'chat_id': chat_id, 'message_id': message_id}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    return get_telegram_client(bot_token).call('deleteMessage', {'chat_id': chat_id, 'message_id': message_id})
 
 def ban_chat_member(bot_token: str, chat_id: int, user_id: int, until_date: Optional[int] = None):
-    url = f'https://api.telegram.org/bot{bot_token}/banChatMember'
     payload = {'chat_id': chat_id, 'user_id': user_id}
     if until_date:
         payload['until_date'] = until_date
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    return get_telegram_client(bot_token).call('banChatMember', payload)
 
 def unban_chat_member(bot_token: str, chat_id: int, user_id: int):
-    url = f'https://api.telegram.org/bot{bot_token}/unbanChatMember'
-    data = json.dumps({'chat_id': chat_id, 'user_id': user_id, 'only_if_banned': True}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    return get_telegram_client(bot_token).call(
+        'unbanChatMember',
+        {'chat_id': chat_id, 'user_id': user_id, 'only_if_banned': True}
+    )
 
 def kick_chat_member(bot_token: str, chat_id: int, user_id: int):
     ban_chat_member(bot_token, chat_id, user_id)
     unban_chat_member(bot_token, chat_id, user_id)
 
+MUTED_PERMISSIONS = {
+    'can_send_messages': False,
+    'can_send_media_messages': False,
+    'can_send_polls': False,
+    'can_send_other_messages': False,
+    'can_add_web_page_previews': False,
+    'can_change_info': False,
+    'can_invite_users': False,
+    'can_pin_messages': False
+}
+MEMBER_PERMISSIONS = {
+    'can_send_messages': True,
+    'can_send_media_messages': True,
+    'can_send_polls': True,
+    'can_send_other_messages': True,
+    'can_add_web_page_previews': True,
+    'can_change_info': False,
+    'can_invite_users': False,
+    'can_pin_messages': False
+}
+
 def restrict_chat_member(bot_token: str, chat_id: int, user_id: int, until_timestamp: int):
-    url = f'https://api.telegram.org/bot{bot_token}/restrictChatMember'
-    permissions = {
-        'can_send_messages': False,
-        'can_send_media_messages': False,
-        'can_send_polls': False,
-        'can_send_other_messages': False,
-        'can_add_web_page_previews': False,
-        'can_change_info': False,
-        'can_invite_users': False,
-        'can_pin_messages': False
-    }
-    data = json.dumps({
+    return get_telegram_client(bot_token).call('restrictChatMember', {
         'chat_id': chat_id,
         'user_id': user_id,
-        'permissions': permissions,
+        'permissions': MUTED_PERMISSIONS,
         'until_date': until_timestamp
-    }).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    })
 
 def unrestrict_chat_member(bot_token: str, chat_id: int, user_id: int):
-    url = f'https://api.telegram.org/bot{bot_token}/restrictChatMember'
-    permissions = {
-        'can_send_messages': True,
-        'can_send_media_messages': True,
-        'can_send_polls': True,
-        'can_send_other_messages': True,
-        'can_add_web_page_previews': True,
-        'can_change_info': False,
-        'can_invite_users': False,
-        'can_pin_messages': False
-    }
-    data = json.dumps({
+    return get_telegram_client(bot_token).call('restrictChatMember', {
         'chat_id': chat_id,
         'user_id': user_id,
-        'permissions': permissions
-    }).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+        'permissions': MEMBER_PERMISSIONS
+    })
 
 def set_chat_title(bot_token: str, chat_id: int, title: str):
-    url = f'https://api.telegram.org/bot{bot_token}/setChatTitle'
-    data = json.dumps({'chat_id': chat_id, 'title': title}).encode('utf-8')
-    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception:
-        pass
+    return get_telegram_client(bot_token).call('setChatTitle', {'chat_id': chat_id, 'title': title})
 
 def get_user_id_by_username(username: str) -> Optional[int]:
     with get_db_connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
-                "SELECT telegram_id FROM bot_managers WHERE telegram_username = %s",
-                (username,)
+                """SELECT COALESCE(
+                       (SELECT user_id FROM users WHERE LOWER(username) = LOWER(%(username)s)),
+                       (SELECT telegram_id FROM bot_managers WHERE telegram_username = %(username)s)
+                   ) AS user_id""",
+                {'username': username}
             )
-            result = cur.fetchone()
-            if result and result['telegram_id']:
-                return result['telegram_id']
-            
+            return cur.fetchone()['user_id']
+
+def extract_update_users(update: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Все пользователи, которых видно в апдейте: автор, автор сообщения в reply и text_mention"""
+    users = []
+    message = update.get('message')
+    if message:
+        if 'from' in message:
+            users.append(message['from'])
+        reply = message.get('reply_to_message')
+        if reply and 'from' in reply:
+            users.append(reply['from'])
+        for entity in message.get('entities', []):
+            if entity.get('type') == 'text_mention' and entity.get('user'):
+                users.append(entity['user'])
+    elif 'callback_query' in update:
+        users.append(update['callback_query']['from'])
+    return users
+
+def remember_users(users: List[Dict[str, Any]]):
+    """Записать пользователей в справочник одним запросом; уже известные без изменений пропускаются"""
+    pending: Dict[int, tuple] = {}
+    for user in users:
+        entry = (user.get('username') or None, user.get('first_name'))
+        if _user_directory_cache.get(user['id']) != entry:
+            pending[user['id']] = entry
+    # Один юзернейм в пачке может встретиться у двух id (сменил владельца) - оставляем последний
+    owners = {username.lower(): user_id for user_id, (username, _) in pending.items() if username}
+    pending = {user_id: entry for user_id, entry in pending.items() if not entry[0] or owners[entry[0].lower()] == user_id}
+    if not pending:
+        return
+    
+    # Одинаковый порядок вставки во всех потоках, чтобы параллельные пачки не взаимоблокировались
+    user_ids = sorted(pending)
+    usernames = [pending[user_id][0] for user_id in user_ids]
+    first_names = [pending[user_id][1] for user_id in user_ids]
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Сначала освобождаем юзернеймы, перешедшие к другим пользователям, иначе упадёт уникальный индекс
             cur.execute(
-                "SELECT user_id FROM user_currency WHERE username = %s",
-                (username,)
+                """UPDATE users SET username = NULL, updated_at = CURRENT_TIMESTAMP
+                   FROM unnest(%(user_ids)s::bigint[], %(usernames)s::text[]) AS u(user_id, username)
+                   WHERE LOWER(users.username) = LOWER(u.username) AND users.user_id <> u.user_id;
+                   INSERT INTO users (user_id, username, first_name, updated_at)
+                   SELECT user_id, username, first_name, CURRENT_TIMESTAMP
+                   FROM unnest(%(user_ids)s::bigint[], %(usernames)s::text[], %(first_names)s::text[]) AS u(user_id, username, first_name)
+                   ON CONFLICT (user_id)
+                   DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, updated_at = CURRENT_TIMESTAMP
+                   WHERE users.username IS DISTINCT FROM EXCLUDED.username OR users.first_name IS DISTINCT FROM EXCLUDED.first_name""",
+                {'user_ids': user_ids, 'usernames': usernames, 'first_names': first_names}
             )
-            result = cur.fetchone()
-            return result['user_id'] if result else None
+            conn.commit()
+    for user_id, entry in pending.items():
+        _user_directory_cache.set(user_id, entry)
 
 def get_target_user_from_message(message: Dict[str, Any], args: List[str]) -> Optional[tuple]:
     """Получить user_id и username цели из reply или mention"""
@@ -236,114 +1115,249 @@ def get_target_user_from_message(message: Dict[str, Any], args: List[str]) -> Op
                     user = entity['user']
                     return (user['id'], user.get('username', ''))
         
-        # Пытаемся найти в базе
+        # Пытаемся найти в справочнике пользователей
         user_id = get_user_id_by_username(target_username)
         if user_id:
             return (user_id, target_username)
     
     return None
 
-def handle_command(message: Dict[str, Any], bot_token: str) -> Optional[str]:
-    text = message.get('text', '')
-    chat_id = message['chat']['id']
-    from_user = message['from']
-    from_username = from_user.get('username', '')
-    from_user_id = from_user['id']
-    message_id = message['message_id']
-    is_private = message['chat']['type'] == 'private'
+class CommandRequest:
+    """Разобранное сообщение с командой и лениво загружаемым контекстом автора"""
     
-    if not text.startswith('/'):
+    def __init__(self, message: Dict[str, Any], bot_token: str, command: str, args_text: str):
+        self.message = message
+        self.bot_token = bot_token
+        self.command = command
+        self.args_text = args_text
+        self.args = args_text.split()
+        self.chat_id = message['chat']['id']
+        self.from_user_id = message['from']['id']
+        self.from_username = message['from'].get('username', '')
+        self.message_id = message['message_id']
+        self.is_private = message['chat']['type'] == 'private'
+        self.caller = CallerContext(self.chat_id, self.from_user_id, self.from_username)
+
+class Command(NamedTuple):
+    name: str
+    handler: Callable[..., Optional[str]]
+    section: str
+    help: str
+    usage: str = ''
+    ranks: Tuple[str, ...] = ()
+    admin_level: Optional[int] = None
+    owner: bool = False
+    private_only: bool = False
+    parse_args: Optional[Callable[[List[str]], tuple]] = None
+    invalid_args_message: Optional[str] = None
+    denied_message: Optional[str] = None
+
+def parse_username(args: List[str]) -> tuple:
+    if len(args) < 1:
+        raise IndexError
+    return (args[0].replace('@', ''),)
+
+def parse_username_and_int(args: List[str]) -> tuple:
+    if len(args) < 2:
+        raise IndexError
+    return (args[0].replace('@', ''), int(args[1]))
+
+def parse_text(args: List[str]) -> tuple:
+    if not args:
+        raise IndexError
+    return ()
+
+def parse_banchat(args: List[str]) -> tuple:
+    if len(args) < 3:
+        raise IndexError
+    return (args[0], ' '.join(args[1:-1]), int(args[-1]))
+
+def has_command_permission(command: Command, caller: CallerContext) -> bool:
+    if not command.ranks and command.admin_level is None and not command.owner:
+        return True
+    if command.ranks and caller.manager_rank in command.ranks:
+        return True
+    if command.owner and caller.is_owner:
+        return True
+    if command.admin_level is not None and caller.admin_level and caller.admin_level >= command.admin_level:
+        return True
+    return False
+
+class ListView(NamedTuple):
+    """Описание списка для постраничного вывода: выборка по ключу, ключ строки и строка текста"""
+    code: str
+    command: str
+    title: str
+    empty_text: str
+    fetch: Callable[[int, Optional[str], int], List[Dict[str, Any]]]
+    key: Callable[[Dict[str, Any]], str]
+    render_item: Callable[[Dict[str, Any]], str]
+
+def telegram_text_length(text: str) -> int:
+    """Длина текста так, как её считает Telegram: в UTF-16 code units"""
+    return len(text.encode('utf-16-le')) // 2
+
+def render_list_page(view: ListView, chat_id: int, after: Optional[str] = None) -> tuple:
+    """Страница списка после ключа after и клавиатура навигации; страница всегда укладывается в одно сообщение"""
+    rows = view.fetch(chat_id, after, LIST_PAGE_SIZE + 1)
+    if not rows and after is None:
+        return view.empty_text, None
+    
+    lines = [view.title]
+    length = telegram_text_length(view.title)
+    shown = 0
+    for row in rows[:LIST_PAGE_SIZE]:
+        item = view.render_item(row)
+        item_length = telegram_text_length(item) + 1
+        if shown and length + item_length > TELEGRAM_MESSAGE_LIMIT:
+            break
+        lines.append(item)
+        length += item_length
+        shown += 1
+    
+    navigation = []
+    if after is not None:
+        navigation.append({'text': '⏮ В начало', 'callback_data': f'list:{view.code}:'})
+    if shown < len(rows):
+        navigation.append({'text': 'Далее ➡️', 'callback_data': f'list:{view.code}:{view.key(rows[shown - 1])}'})
+    return "\n".join(lines), {'inline_keyboard': [navigation]} if navigation else None
+
+def send_list_dump(view: ListView, bot_token: str, chat_id: int) -> int:
+    """Выгрузить список не больше чем в LIST_DUMP_MAX_MESSAGES сообщениях, дальше - кнопка постраничного просмотра"""
+    messages = 0
+    lines = [view.title]
+    length = telegram_text_length(view.title)
+    after = None
+    shown = 0
+    last_key = None
+    truncated = False
+    while not truncated:
+        rows = view.fetch(chat_id, after, LIST_DUMP_BATCH_SIZE)
+        for row in rows:
+            item = view.render_item(row)
+            item_length = telegram_text_length(item) + 1
+            # Режем только между строками, чтобы не разорвать HTML-теги
+            if length + item_length > TELEGRAM_MESSAGE_LIMIT:
+                send_telegram_message(bot_token, chat_id, "\n".join(lines))
+                messages += 1
+                lines, length = [], 0
+                if messages >= LIST_DUMP_MAX_MESSAGES:
+                    truncated = True
+                    break
+            lines.append(item)
+            length += item_length
+            shown += 1
+            last_key = view.key(row)
+        if len(rows) < LIST_DUMP_BATCH_SIZE:
+            break
+        after = view.key(rows[-1])
+    
+    if truncated:
+        keyboard = {'inline_keyboard': [[{'text': 'Далее ➡️', 'callback_data': f'list:{view.code}:{last_key}'}]]}
+        send_telegram_message(bot_token, chat_id, f"Показаны первые {shown}. Остальное - постранично:", reply_markup=keyboard)
+        return messages + 1
+    
+    if messages == 0 and len(lines) == 1:
+        lines = [view.empty_text]
+    send_telegram_message(bot_token, chat_id, "\n".join(lines))
+    return messages + 1
+
+def show_list(req: CommandRequest, view: ListView) -> Optional[str]:
+    """Ответ списочной команды: первая страница с кнопками или, с аргументом all, весь список"""
+    if req.args[:1] == ['all']:
+        send_list_dump(view, req.bot_token, req.chat_id)
         return None
     
-    parts = text.split(maxsplit=1)
-    command = parts[0].lower().replace('@', '').split('@')[0]
-    args_text = parts[1] if len(parts) > 1 else ''
-    args = args_text.split()
-    
-    manager_rank = get_manager_rank(from_username)
-    admin_level = get_chat_admin_level(chat_id, from_username)
-    is_owner = is_chat_owner(chat_id, from_username)
-    
-    # Команда /me - для всех пользователей
-    if command == '/me':
-        rank_text = 'Пользователь'
-        if manager_rank == 'founder':
-            rank_text = '👑 Основатель бота'
-        elif manager_rank == 'deputy':
-            rank_text = '⭐ Зам. Основателя'
-        elif manager_rank == 'agent':
-            rank_text = '🎖️ Сотрудник'
-        elif is_owner:
-            rank_text = '👔 Владелец чата'
-        elif admin_level:
-            rank_text = f'🛡️ Администратор {admin_level} уровня'
-        
-        balance = get_user_balance(from_user_id, from_username)
-        premium = get_user_premium(from_user_id)
-        premium_text = f"до {premium.strftime('%d.%m.%Y %H:%M')}" if premium else "Нет"
-        
-        return f"""<b>👤 Ваш профиль</b>
+    text, keyboard = render_list_page(view, req.chat_id)
+    if keyboard is None:
+        return text
+    
+    send_telegram_message(req.bot_token, req.chat_id, text, reply_markup=keyboard)
+    return None
 
-Юзернейм: @{from_username}
+def cmd_me(req: CommandRequest) -> Optional[str]:
+    profile = get_profile(req.chat_id, req.from_user_id, req.from_username)
+    rank_text = 'Пользователь'
+    if profile['manager_rank'] == 'founder':
+        rank_text = '👑 Основатель бота'
+    elif profile['manager_rank'] == 'deputy':
+        rank_text = '⭐ Зам. Основателя'
+    elif profile['manager_rank'] == 'agent':
+        rank_text = '🎖️ Сотрудник'
+    elif profile['is_owner']:
+        rank_text = '👔 Владелец чата'
+    elif profile['admin_level']:
+        rank_text = f"🛡️ Администратор {profile['admin_level']} уровня"
+    
+    balance = profile['balance']
+    premium = profile['premium']
+    premium_text = f"до {premium.strftime('%d.%m.%Y %H:%M')}" if premium else "Нет"
+    
+    return f"""<b>👤 Ваш профиль</b>
+
+Юзернейм: @{req.from_username}
 Ранг: {rank_text}
-ID: {from_user_id}
+ID: {req.from_user_id}
 💎 Брюликов: {balance}
 ⭐ Premium: {premium_text}"""
+
+def cmd_balance(req: CommandRequest) -> Optional[str]:
+    balance = get_user_balance(req.from_user_id, req.from_username)
+    return f"💎 Ваш баланс: <b>{balance}</b> брюликов"
+
+def cmd_farm(req: CommandRequest) -> Optional[str]:
+    amount = random.randint(10, 100)
+    # Один оператор: начисление только если с прошлого фарма прошёл час по часам БД,
+    # иначе возвращается текущая строка с временем до следующего фарма
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """WITH farmed AS (
+                       INSERT INTO user_currency (user_id, username, balance, last_farm, updated_at)
+                       VALUES (%(user_id)s, %(username)s, %(amount)s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                       ON CONFLICT (user_id)
+                       DO UPDATE SET balance = user_currency.balance + EXCLUDED.balance, last_farm = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                       WHERE user_currency.last_farm IS NULL OR user_currency.last_farm <= CURRENT_TIMESTAMP - INTERVAL '1 hour'
+                       RETURNING balance
+                   )
+                   SELECT TRUE AS farmed, balance, 0 AS wait_seconds FROM farmed
+                   UNION ALL
+                   SELECT FALSE, balance, GREATEST(EXTRACT(EPOCH FROM last_farm + INTERVAL '1 hour' - CURRENT_TIMESTAMP), 0)
+                   FROM user_currency
+                   WHERE user_id = %(user_id)s AND NOT EXISTS (SELECT 1 FROM farmed)""",
+                {'user_id': req.from_user_id, 'username': req.from_username, 'amount': amount}
+            )
+            result = cur.fetchone()
     
-    # Команда /balance - показать баланс
-    if command == '/balance':
-        balance = get_user_balance(from_user_id, from_username)
-        return f"💎 Ваш баланс: <b>{balance}</b> брюликов"
+    # Пустой результат - параллельный /farm только что создал строку этого пользователя
+    if not result or not result['farmed']:
+        wait_seconds = result['wait_seconds'] if result else 3600
+        wait_minutes = int(wait_seconds / 60)
+        return f"⏰ Вы уже собирали брюлики! Следующий фарм через {wait_minutes} минут"
     
-    # Команда /farm - получить брюлики
-    if command == '/farm':
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    "SELECT last_farm FROM user_currency WHERE user_id = %s",
-                    (from_user_id,)
-                )
-                result = cur.fetchone()
-                
-                if result and result['last_farm']:
-                    next_farm = result['last_farm'] + timedelta(hours=1)
-                    if datetime.now() < next_farm:
-                        wait_minutes = int((next_farm - datetime.now()).total_seconds() / 60)
-                        return f"⏰ Вы уже собирали брюлики! Следующий фарм через {wait_minutes} минут"
-                
-                amount = random.randint(10, 100)
-                cur.execute(
-                    """INSERT INTO user_currency (user_id, username, balance, last_farm, updated_at)
-                       VALUES (%s, %s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                       ON CONFLICT (user_id)
-                       DO UPDATE SET balance = user_currency.balance + %s, last_farm = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP""",
-                    (from_user_id, from_username, amount, amount)
-                )
-                conn.commit()
-                
-                balance = get_user_balance(from_user_id, from_username)
-                return f"✅ Вы собрали <b>{amount}</b> брюликов!\n💎 Текущий баланс: <b>{balance}</b>"
-    
-    # Команда /premium - купить или посмотреть подписку
-    if command == '/premium':
-        premium = get_user_premium(from_user_id)
-        if premium:
-            return f"⭐ У вас есть Premium подписка до {premium.strftime('%d.%m.%Y %H:%M')}"
-        
-        balance = get_user_balance(from_user_id, from_username)
-        
-        keyboard = {
-            'inline_keyboard': [
-                [{'text': '⭐ 3 дня - 100 💎', 'callback_data': 'premium_3'}],
-                [{'text': '✨ 7 дней - 250 💎', 'callback_data': 'premium_7'}],
-                [{'text': '🌟 30 дней - 1000 💎', 'callback_data': 'premium_30'}]
-            ]
-        }
-        
-        send_telegram_message(
-            bot_token,
-            chat_id,
-            f"""<b>⭐ Premium подписка</b>
+    return f"✅ Вы собрали <b>{amount}</b> брюликов!\n💎 Текущий баланс: <b>{result['balance']}</b>"
+
+# callback_data кнопки -> (дней подписки, стоимость в брюликах)
+PREMIUM_PLANS = {'premium_3': (3, 100), 'premium_7': (7, 250), 'premium_30': (30, 1000)}
+PREMIUM_KEYBOARD = {
+    'inline_keyboard': [
+        [{'text': '⭐ 3 дня - 100 💎', 'callback_data': 'premium_3'}],
+        [{'text': '✨ 7 дней - 250 💎', 'callback_data': 'premium_7'}],
+        [{'text': '🌟 30 дней - 1000 💎', 'callback_data': 'premium_30'}]
+    ]
+}
+
+def cmd_premium(req: CommandRequest) -> Optional[str]:
+    premium = req.caller.premium
+    if premium:
+        return f"⭐ У вас есть Premium подписка до {premium.strftime('%d.%m.%Y %H:%M')}"
+    
+    balance = req.caller.balance
+    
+    send_telegram_message(
+        req.bot_token,
+        req.chat_id,
+        f"""<b>⭐ Premium подписка</b>
 
 С Premium вы можете:
 • Писать сообщения от лица бота (/pmessage)
@@ -351,487 +1365,549 @@ ID: {from_user_id}
 💎 Ваш баланс: <b>{balance}</b> брюликов
 
 Выберите подписку:""",
-            reply_markup=keyboard
-        )
-        return None
+        reply_markup=PREMIUM_KEYBOARD
+    )
+    return None
+
+def cmd_pmessage(req: CommandRequest) -> Optional[str]:
+    premium = req.caller.premium
+    if not premium:
+        return "❌ Эта команда доступна только для Premium пользователей. Используйте /premium для покупки"
     
-    # Команда /pmessage - для премиум пользователей
-    if command == '/pmessage':
-        premium = get_user_premium(from_user_id)
-        if not premium:
-            return "❌ Эта команда доступна только для Premium пользователей. Используйте /premium для покупки"
-        
-        if not args_text:
-            return "❌ Использование: /pmessage текст сообщения"
-        
-        delete_telegram_message(bot_token, chat_id, message_id)
-        send_telegram_message(bot_token, chat_id, args_text)
-        return None
+    if not req.args_text:
+        return "❌ Использование: /pmessage текст сообщения"
     
-    # Команда /sreport - отправить репорт (только в ЛС)
-    if command == '/sreport':
-        if not is_private:
-            return "❌ Эта команда доступна только в личных сообщениях с ботом"
-        
-        if not args_text:
-            return "❌ Использование: /sreport текст репорта"
-        
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO user_reports (user_id, username, report_text) VALUES (%s, %s, %s)",
-                    (from_user_id, from_username, args_text)
-                )
-                conn.commit()
-        
-        return "✅ Ваш репорт отправлен сотрудникам!"
+    delete_telegram_message(req.bot_token, req.chat_id, req.message_id)
+    send_telegram_message(req.bot_token, req.chat_id, req.args_text)
+    return None
+
+def cmd_sreport(req: CommandRequest) -> Optional[str]:
+    if not req.args_text:
+        return "❌ Использование: /sreport текст репорта"
     
-    # Команда /reports - для сотрудников+
-    if command == '/reports':
-        if manager_rank not in ['founder', 'deputy', 'agent']:
-            return "❌ Эта команда доступна только для Сотрудников и выше"
-        
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(
-                    "SELECT id, user_id, username, report_text, created_at FROM user_reports WHERE viewed = FALSE ORDER BY created_at DESC LIMIT 10"
-                )
-                reports = cur.fetchall()
-        
-        if not reports:
-            return "📋 Новых репортов нет"
-        
-        text = "<b>📋 Непрочитанные репорты:</b>\n\n"
-        for r in reports:
-            text += f"ID: {r['id']}\nОт: @{r['username']} (ID: {r['user_id']})\nТекст: {r['report_text']}\nДата: {r['created_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
-        
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO user_reports (user_id, username, report_text) VALUES (%s, %s, %s)",
+                (req.from_user_id, req.from_username, req.args_text)
+            )
+            conn.commit()
+    
+    return "✅ Ваш репорт отправлен сотрудникам!"
+
+def encode_report_key(report: Dict[str, Any]) -> str:
+    """Ключ (created_at, id) для callback_data, укладывается в лимит 64 байта"""
+    return f"{encode_timestamp_key(report['created_at'])}:{report['id']}"
+
+def decode_report_key(micros: str, report_id: str) -> tuple:
+    return (decode_timestamp_key(micros), int(report_id))
+
+def fetch_reports_page(direction: str = 'first', key: Optional[tuple] = None) -> tuple:
+    """Страница непрочитанных репортов от новых к старым по ключу (created_at, id); возвращает (репорты, есть_новее, есть_старше)"""
+    # Берём на одну строку больше, чтобы узнать, есть ли следующая страница в этом направлении
+    params: Dict[str, Any] = {'limit': REPORTS_PAGE_SIZE + 1}
+    if direction == 'prev':
+        condition, order = "AND (created_at, id) > (%(created_at)s, %(id)s)", "created_at, id"
+    elif direction == 'next':
+        condition, order = "AND (created_at, id) < (%(created_at)s, %(id)s)", "created_at DESC, id DESC"
+    else:
+        condition, order = "", "created_at DESC, id DESC"
+    if key:
+        params['created_at'], params['id'] = key
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"""SELECT id, user_id, username, report_text, created_at FROM user_reports
+                    WHERE viewed = FALSE {condition}
+                    ORDER BY {order}
+                    LIMIT %(limit)s""",
+                params
+            )
+            reports = cur.fetchall()
+    
+    has_more = len(reports) > REPORTS_PAGE_SIZE
+    reports = reports[:REPORTS_PAGE_SIZE]
+    if direction == 'prev':
+        return list(reversed(reports)), has_more, True
+    return reports, direction == 'next', has_more
+
+def mark_reports_viewed(newest: tuple, oldest: tuple) -> int:
+    """Отметить прочитанными все непрочитанные репорты между ключами страницы одним оператором"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE user_reports SET viewed = TRUE
+                   WHERE viewed = FALSE AND (created_at, id) <= (%s, %s) AND (created_at, id) >= (%s, %s)""",
+                (*newest, *oldest)
+            )
+            conn.commit()
+            return cur.rowcount
+
+def render_reports_page(reports: List[Dict[str, Any]], has_newer: bool, has_older: bool) -> tuple:
+    """Текст страницы репортов и клавиатура навигации"""
+    if not reports:
+        return "📋 Новых репортов нет", None
+    
+    lines = ["<b>📋 Непрочитанные репорты:</b>\n"]
+    length = telegram_text_length(lines[0])
+    for shown, r in enumerate(reports):
+        text = r['report_text'] or ''
+        if len(text) > REPORT_PREVIEW_LENGTH:
+            text = text[:REPORT_PREVIEW_LENGTH] + '…'
+        username = r['username'] or ''
+        created_at = r['created_at'].strftime('%d.%m.%Y %H:%M')
+        item = f"ID: {r['id']}\nОт: @{html.escape(username)} (ID: {r['user_id']})\nТекст: {html.escape(text)}\nДата: {created_at}\n"
+        # Telegram считает длину после разбора HTML, поэтому меряем неэкранированный текст
+        item_length = telegram_text_length(f"ID: {r['id']}\nОт: @{username} (ID: {r['user_id']})\nТекст: {text}\nДата: {created_at}\n") + 1
+        if shown and length + item_length > TELEGRAM_MESSAGE_LIMIT:
+            # Не уместившиеся репорты остаются непрочитанными и открываются кнопкой «Старше»
+            reports, has_older = reports[:shown], True
+            break
+        lines.append(item)
+        length += item_length
+    
+    newest_key = encode_report_key(reports[0])
+    oldest_key = encode_report_key(reports[-1])
+    navigation = []
+    if has_newer:
+        navigation.append({'text': '⬅️ Новее', 'callback_data': f'rep_prev:{newest_key}'})
+    if has_older:
+        navigation.append({'text': 'Старше ➡️', 'callback_data': f'rep_next:{oldest_key}'})
+    keyboard = [[{'text': '✅ Отметить прочитанными', 'callback_data': f'rep_read:{newest_key}:{oldest_key}'}]]
+    if navigation:
+        keyboard.insert(0, navigation)
+    return "\n".join(lines), {'inline_keyboard': keyboard}
+
+def cmd_reports(req: CommandRequest) -> Optional[str]:
+    text, keyboard = render_reports_page(*fetch_reports_page())
+    if keyboard is None:
         return text
     
-    # Команда /commands
-    if command == '/commands':
-        return """<b>📋 Доступные команды:</b>
-
-<b>👥 Для всех пользователей:</b>
-/me - Показать свой профиль и ранг
-/balance - Показать баланс брюликов
-/farm - Собрать брюлики (раз в час)
-/premium - Купить Premium подписку
-/commands - Показать список команд
-/profile [юзернейм] - Показать профиль пользователя
-/sreport текст - Отправить репорт (только в ЛС)
-
-<b>⭐ Premium команды:</b>
-/pmessage текст - Написать от лица бота
-
-<b>👔 Команды менеджеров бота:</b>
-<b>Основатель:</b>
-/szamrang [юзернейм] - Назначить зама основателя
-/deltechat [ссылка] - Удалить бота из чата
-/banchat [ссылка] [причина] [дни] - Заблокировать чат
-
-<b>Зам. Основателя:</b>
-/agent [юзернейм] - Назначить сотрудника
-/unagent [юзернейм] - Снять сотрудника
-/serverban [юзернейм] - Глобальный бан
-/brulik [юзернейм] [число] - Выдать брюлики
-
-<b>Сотрудник:</b>
-/agents - Список сотрудников
-/chats - Список чатов
-/reports - Просмотр репортов
-
-<b>🛡️ Команды модерации чата:</b>
-<b>Владелец:</b>
-/unrang [юзернейм] - Снять ранг
-/gban [юзернейм] - Забанить навсегда
-
-<b>Администратор 5 уровня:</b>
-/rang [юзернейм] [уровень 1-5] - Назначить админа
-/chatname текст - Переименовать чат
-
-<b>Администратор 4 уровня:</b>
-/unban [юзернейм] - Разбанить пользователя
-/tban [юзернейм] [причина] [время_минут] - Временный бан
-
-<b>Администратор 2 уровня:</b>
-/mute [юзернейм] [минуты] - Замутить пользователя
-/unmute [юзернейм] - Размутить пользователя
-
-<b>Администратор 1 уровня:</b>
-/mutelist - Список замученных
-/banlist - Список забаненных"""
-    
-    if command == '/profile':
-        target_username = args[0].replace('@', '') if args else from_username
-        
-        manager_rank_target = get_manager_rank(target_username)
-        admin_level_target = get_chat_admin_level(chat_id, target_username)
-        
-        rank_text = 'Пользователь'
-        if manager_rank_target == 'founder':
-            rank_text = '👑 Основатель бота'
-        elif manager_rank_target == 'deputy':
-            rank_text = '⭐ Зам. Основателя'
-        elif manager_rank_target == 'agent':
-            rank_text = '🎖️ Сотрудник'
-        elif admin_level_target:
-            rank_text = f'🛡️ Администратор {admin_level_target} уровня'
-        elif is_chat_owner(chat_id, target_username):
-            rank_text = '👔 Владелец чата'
-        
-        target_user_id = get_user_id_by_username(target_username)
-        if target_user_id:
-            balance = get_user_balance(target_user_id, target_username)
-            premium = get_user_premium(target_user_id)
-            premium_text = f"до {premium.strftime('%d.%m.%Y')}" if premium else "Нет"
-        else:
-            balance = 0
-            premium_text = "Нет"
-        
-        return f"""<b>👤 Профиль пользователя</b>
+    send_telegram_message(req.bot_token, req.chat_id, text, reply_markup=keyboard)
+    return None
+
+def cmd_commands(req: CommandRequest) -> Optional[str]:
+    return COMMANDS_HELP_TEXT
+
+def cmd_profile(req: CommandRequest) -> Optional[str]:
+    chat_id = req.chat_id
+    target_username = req.args[0].replace('@', '') if req.args else req.from_username
+    
+    # Свой профиль ищем по id, чужой - по юзернейму
+    target_user_id = req.from_user_id if target_username == req.from_username else None
+    profile = get_profile(chat_id, target_user_id, target_username)
+    target_user_id = profile['user_id']
+    
+    rank_text = 'Пользователь'
+    if profile['manager_rank'] == 'founder':
+        rank_text = '👑 Основатель бота'
+    elif profile['manager_rank'] == 'deputy':
+        rank_text = '⭐ Зам. Основателя'
+    elif profile['manager_rank'] == 'agent':
+        rank_text = '🎖️ Сотрудник'
+    elif profile['admin_level']:
+        rank_text = f"🛡️ Администратор {profile['admin_level']} уровня"
+    elif profile['is_owner']:
+        rank_text = '👔 Владелец чата'
+    
+    balance = profile['balance']
+    premium = profile['premium']
+    premium_text = f"до {premium.strftime('%d.%m.%Y')}" if premium else "Нет"
+    
+    return f"""<b>👤 Профиль пользователя</b>
 
 Юзернейм: @{target_username}
 Ранг: {rank_text}
 ID: {target_user_id or 'Не указан'}
 💎 Брюликов: {balance}
 ⭐ Premium: {premium_text}"""
-    
-    # Команды для Зам. Основателя+
-    if manager_rank in ['founder', 'deputy']:
-        if command == '/unagent' and len(args) >= 1:
-            target_username = args[0].replace('@', '')
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "DELETE FROM bot_managers WHERE telegram_username = %s AND manager_rank = 'agent'",
-                        (target_username,)
-                    )
-                    if cur.rowcount > 0:
-                        conn.commit()
-                        return f"✅ @{target_username} снят с должности Сотрудника"
-                    else:
-                        return f"❌ @{target_username} не является Сотрудником"
-        
-        if command == '/brulik' and len(args) >= 2:
-            target_username = args[0].replace('@', '')
-            try:
-                amount = int(args[1])
-                target_user_id = get_user_id_by_username(target_username)
-                if not target_user_id:
-                    return f"❌ Пользователь @{target_username} не найден"
-                
-                update_user_balance(target_user_id, target_username, amount)
-                new_balance = get_user_balance(target_user_id, target_username)
-                return f"✅ Пользователю @{target_username} выдано {amount} брюликов. Новый баланс: {new_balance}"
-            except ValueError:
-                return "❌ Неверное количество брюликов"
-    
-    # Команды модерации - /gban для владельца
-    if is_owner:
-        if command == '/gban':
-            target_info = get_target_user_from_message(message, args)
-            
-            if not target_info:
-                return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
-            
-            target_user_id, target_username = target_info
-            
-            ban_chat_member(bot_token, chat_id, target_user_id)
-            
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO chat_bans (chat_id, user_id, username, banned_until) VALUES (%s, %s, %s, NULL) ON CONFLICT DO NOTHING",
-                        (chat_id, target_user_id, target_username)
-                    )
-                    conn.commit()
-            
-            send_telegram_message(
-                bot_token,
-                chat_id,
-                f"🚫 <b>Пользователь забанен навсегда</b>\n\n👤 @{target_username}"
+
+def cmd_unagent(req: CommandRequest, target_username: str) -> Optional[str]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM bot_managers WHERE telegram_username = %s AND manager_rank = 'agent'",
+                (target_username,)
             )
-            return None
+            removed = cur.rowcount > 0
+            conn.commit()
+    invalidate_after_commit(_manager_rank_cache, target_username)
+    if removed:
+        return f"✅ @{target_username} снят с должности Сотрудника"
+    return f"❌ @{target_username} не является Сотрудником"
+
+def cmd_brulik(req: CommandRequest, target_username: str, amount: int) -> Optional[str]:
+    target_user_id = get_user_id_by_username(target_username)
+    if not target_user_id:
+        return f"❌ Пользователь @{target_username} не найден"
     
-    # Команды для Администратора 5 уровня
-    if admin_level and admin_level >= 5:
-        if command == '/chatname' and args_text:
-            result = set_chat_title(bot_token, chat_id, args_text)
-            if result and result.get('ok'):
-                return f"✅ Название чата изменено на: {args_text}"
-            else:
-                return "❌ Не удалось изменить название чата. Убедитесь, что бот является администратором"
-    
-    # Команды для Администратора 4 уровня
-    if admin_level and admin_level >= 4:
-        if command == '/unban':
-            target_info = get_target_user_from_message(message, args)
-            
-            if not target_info:
-                return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
-            
-            target_user_id, target_username = target_info
-            
-            unban_chat_member(bot_token, chat_id, target_user_id)
-            
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "DELETE FROM chat_bans WHERE chat_id = %s AND user_id = %s",
-                        (chat_id, target_user_id)
-                    )
-                    conn.commit()
-            
-            send_telegram_message(
-                bot_token,
-                chat_id,
-                f"✅ <b>Пользователь разбанен</b>\n\n👤 @{target_username}"
-            )
-            return None
+    update_user_balance(target_user_id, target_username, amount)
+    new_balance = get_user_balance(target_user_id, target_username)
+    return f"✅ Пользователю @{target_username} выдано {amount} брюликов. Новый баланс: {new_balance}"
+
+def cmd_gban(req: CommandRequest) -> Optional[str]:
+    target_info = get_target_user_from_message(req.message, req.args)
+    
+    if not target_info:
+        return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
+    
+    target_user_id, target_username = target_info
+    
+    ban_chat_member(req.bot_token, req.chat_id, target_user_id)
+    
+    save_chat_ban(req.chat_id, target_user_id, target_username, None)
+    
+    send_telegram_message(
+        req.bot_token,
+        req.chat_id,
+        f"🚫 <b>Пользователь забанен навсегда</b>\n\n👤 @{target_username}"
+    )
+    return None
+
+def cmd_chatname(req: CommandRequest) -> Optional[str]:
+    result = set_chat_title(req.bot_token, req.chat_id, req.args_text)
+    if result and result.get('ok'):
+        return f"✅ Название чата изменено на: {req.args_text}"
+    else:
+        return "❌ Не удалось изменить название чата. Убедитесь, что бот является администратором"
+
+def cmd_unban(req: CommandRequest) -> Optional[str]:
+    target_info = get_target_user_from_message(req.message, req.args)
+    
+    if not target_info:
+        return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
+    
+    target_user_id, target_username = target_info
+    
+    unban_chat_member(req.bot_token, req.chat_id, target_user_id)
+    
+    delete_chat_ban(req.chat_id, target_user_id)
+    
+    send_telegram_message(
+        req.bot_token,
+        req.chat_id,
+        f"✅ <b>Пользователь разбанен</b>\n\n👤 @{target_username}"
+    )
+    return None
+
+def cmd_tban(req: CommandRequest) -> Optional[str]:
+    message = req.message
+    args = req.args
+    target_info = get_target_user_from_message(message, args)
+    
+    if not target_info:
+        return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
+    
+    target_user_id, target_username = target_info
+    
+    if len(args) < 2:
+        return "❌ Использование: /tban [@юзернейм] [причина] [минуты] или ответьте на сообщение"
+    
+    reason = args[0] if 'reply_to_message' in message else args[1]
+    try:
+        minutes = int(args[1] if 'reply_to_message' in message else args[2])
         
-        if command == '/tban':
-            target_info = get_target_user_from_message(message, args)
-            
-            if not target_info:
-                return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
-            
-            target_user_id, target_username = target_info
-            
-            if len(args) < 2:
-                return "❌ Использование: /tban [@юзернейм] [причина] [минуты] или ответьте на сообщение"
-            
-            reason = args[0] if 'reply_to_message' in message else args[1]
-            try:
-                minutes = int(args[1] if 'reply_to_message' in message else args[2])
-                
-                until_timestamp = int((datetime.now() + timedelta(minutes=minutes)).timestamp())
-                ban_chat_member(bot_token, chat_id, target_user_id, until_timestamp)
-                
-                with get_db_connection() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO chat_bans (chat_id, user_id, username, banned_until) VALUES (%s, %s, %s, %s) ON CONFLICT (chat_id, user_id) DO UPDATE SET banned_until = %s",
-                            (chat_id, target_user_id, target_username, datetime.fromtimestamp(until_timestamp), datetime.fromtimestamp(until_timestamp))
-                        )
-                        conn.commit()
-                
-                send_telegram_message(
-                    bot_token,
-                    chat_id,
-                    f"🚫 <b>Пользователь забанен</b>\n\n👤 @{target_username}\n⏱ Срок: {minutes} минут\n📝 Причина: {reason}"
-                )
-                return None
-            except ValueError:
-                return "❌ Неверное время бана"
-    
-    # Команды для Администратора 2 уровня
-    if admin_level and admin_level >= 2:
-        if command == '/mute':
-            target_info = get_target_user_from_message(message, args)
-            
-            if not target_info:
-                return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
-            
-            target_user_id, target_username = target_info
-            
-            try:
-                minutes = int(args[0] if 'reply_to_message' in message else args[1])
-                
-                until_timestamp = int((datetime.now() + timedelta(minutes=minutes)).timestamp())
-                restrict_chat_member(bot_token, chat_id, target_user_id, until_timestamp)
-                
-                with get_db_connection() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO chat_mutes (chat_id, user_id, username, muted_until) VALUES (%s, %s, %s, %s) ON CONFLICT (chat_id, user_id) DO UPDATE SET muted_until = %s",
-                            (chat_id, target_user_id, target_username, datetime.fromtimestamp(until_timestamp), datetime.fromtimestamp(until_timestamp))
-                        )
-                        conn.commit()
-                
-                send_telegram_message(
-                    bot_token,
-                    chat_id,
-                    f"🔇 <b>Пользователь замучен</b>\n\n👤 @{target_username}\n⏱ Срок: {minutes} минут"
-                )
-                return None
-            except ValueError:
-                return "❌ Неверное время мута"
+        until_timestamp = int((datetime.now() + timedelta(minutes=minutes)).timestamp())
+        ban_chat_member(req.bot_token, req.chat_id, target_user_id, until_timestamp)
         
-        if command == '/unmute':
-            target_info = get_target_user_from_message(message, args)
-            
-            if not target_info:
-                return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
-            
-            target_user_id, target_username = target_info
-            
-            unrestrict_chat_member(bot_token, chat_id, target_user_id)
-            
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "DELETE FROM chat_mutes WHERE chat_id = %s AND user_id = %s",
-                        (chat_id, target_user_id)
-                    )
-                    conn.commit()
-            
-            send_telegram_message(
-                bot_token,
-                chat_id,
-                f"🔊 <b>Пользователь размучен</b>\n\n👤 @{target_username}"
-            )
-            return None
-    
-    # Команды для Администратора 1 уровня
-    if admin_level and admin_level >= 1:
-        if command == '/mutelist':
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        "SELECT username, muted_until FROM chat_mutes WHERE chat_id = %s AND muted_until > CURRENT_TIMESTAMP ORDER BY muted_until",
-                        (chat_id,)
-                    )
-                    mutes = cur.fetchall()
-            
-            if not mutes:
-                return "📋 Список замученных пуст"
-            
-            text = "<b>📋 Замученные пользователи:</b>\n\n"
-            for m in mutes:
-                text += f"@{m['username']} - до {m['muted_until'].strftime('%d.%m.%Y %H:%M')}\n"
-            
-            return text
+        save_chat_ban(req.chat_id, target_user_id, target_username, datetime.fromtimestamp(until_timestamp))
         
-        if command == '/banlist':
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        "SELECT username, banned_until FROM chat_bans WHERE chat_id = %s ORDER BY banned_until NULLS LAST",
-                        (chat_id,)
-                    )
-                    bans = cur.fetchall()
-            
-            if not bans:
-                return "📋 Список забаненных пуст"
-            
-            text = "<b>📋 Забаненные пользователи:</b>\n\n"
-            for b in bans:
-                if b['banned_until']:
-                    text += f"@{b['username']} - до {b['banned_until'].strftime('%d.%m.%Y %H:%M')}\n"
-                else:
-                    text += f"@{b['username']} - навсегда\n"
-            
-            return text
-    
-    # Остальные команды из оригинального кода
-    if manager_rank == 'founder':
-        if command == '/szamrang' and len(args) >= 1:
-            target_username = args[0].replace('@', '')
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO bot_managers (telegram_username, manager_rank) VALUES (%s, %s) ON CONFLICT (telegram_username) DO UPDATE SET manager_rank = %s",
-                        (target_username, 'deputy', 'deputy')
-                    )
-                    conn.commit()
-            return f"✅ @{target_username} назначен Заместителем Основателя"
+        send_telegram_message(
+            req.bot_token,
+            req.chat_id,
+            f"🚫 <b>Пользователь забанен</b>\n\n👤 @{target_username}\n⏱ Срок: {minutes} минут\n📝 Причина: {reason}"
+        )
+        return None
+    except ValueError:
+        return "❌ Неверное время бана"
+
+def cmd_mute(req: CommandRequest) -> Optional[str]:
+    message = req.message
+    args = req.args
+    target_info = get_target_user_from_message(message, args)
+    
+    if not target_info:
+        return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
+    
+    target_user_id, target_username = target_info
+    
+    try:
+        minutes = int(args[0] if 'reply_to_message' in message else args[1])
         
-        if command == '/deltechat' and len(args) >= 1:
-            return "⚠️ Для удаления бота из чата используйте настройки группы в Telegram"
+        until_timestamp = int((datetime.now() + timedelta(minutes=minutes)).timestamp())
+        restrict_chat_member(req.bot_token, req.chat_id, target_user_id, until_timestamp)
         
-        if command == '/banchat' and len(args) >= 3:
-            chat_link = args[0]
-            ban_days = int(args[-1])
-            reason = ' '.join(args[1:-1])
-            return f"✅ Чат {chat_link} заблокирован на {ban_days} дней. Причина: {reason}"
-    
-    if manager_rank in ['founder', 'deputy']:
-        if command == '/agent' and len(args) >= 1:
-            target_username = args[0].replace('@', '')
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO bot_managers (telegram_username, manager_rank) VALUES (%s, %s) ON CONFLICT (telegram_username) DO UPDATE SET manager_rank = %s",
-                        (target_username, 'agent', 'agent')
-                    )
-                    conn.commit()
-            return f"✅ @{target_username} назначен Сотрудником"
+        save_chat_mute(req.chat_id, target_user_id, target_username, datetime.fromtimestamp(until_timestamp))
         
-        if command == '/serverban' and len(args) >= 1:
-            target_username = args[0].replace('@', '')
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO server_bans (username) VALUES (%s) ON CONFLICT DO NOTHING",
-                        (target_username,)
-                    )
-                    conn.commit()
-            return f"✅ @{target_username} получил глобальный бан"
+        send_telegram_message(
+            req.bot_token,
+            req.chat_id,
+            f"🔇 <b>Пользователь замучен</b>\n\n👤 @{target_username}\n⏱ Срок: {minutes} минут"
+        )
+        return None
+    except ValueError:
+        return "❌ Неверное время мута"
+
+def cmd_unmute(req: CommandRequest) -> Optional[str]:
+    target_info = get_target_user_from_message(req.message, req.args)
     
-    if manager_rank in ['founder', 'deputy', 'agent']:
-        if command == '/agents':
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("SELECT telegram_username, manager_rank FROM bot_managers WHERE manager_rank IN ('founder', 'deputy', 'agent') ORDER BY CASE manager_rank WHEN 'founder' THEN 1 WHEN 'deputy' THEN 2 WHEN 'agent' THEN 3 END")
-                    managers = cur.fetchall()
-            
-            text = "<b>👥 Сотрудники бота:</b>\n\n"
-            for m in managers:
-                rank_emoji = {'founder': '👑', 'deputy': '⭐', 'agent': '🎖️'}
-                rank_name = {'founder': 'Основатель', 'deputy': 'Зам. Основателя', 'agent': 'Сотрудник'}
-                text += f"{rank_emoji.get(m['manager_rank'], '•')} @{m['telegram_username']} - {rank_name.get(m['manager_rank'], '')}\n"
-            
-            return text
-        
-        if command == '/chats':
-            with get_db_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("SELECT chat_id, chat_title, owner_username FROM chats ORDER BY chat_id")
-                    chats = cur.fetchall()
-            
-            text = "<b>💬 Список чатов:</b>\n\n"
-            for c in chats:
-                text += f"Чат ID: {c['chat_id']}\nНазвание: {c['chat_title']}\nВладелец: @{c['owner_username']}\n\n"
-            
-            return text
-    
-    if is_owner or (admin_level and admin_level >= 5):
-        if command == '/rang' and len(args) >= 2:
-            target_username = args[0].replace('@', '')
-            try:
-                level = int(args[1])
-                if level < 1 or level > 5:
-                    return "❌ Уровень администратора должен быть от 1 до 5"
-                
-                with get_db_connection() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO chat_admins (chat_id, telegram_username, admin_level) VALUES (%s, %s, %s) ON CONFLICT (chat_id, telegram_username) DO UPDATE SET admin_level = %s",
-                            (chat_id, target_username, level, level)
-                        )
-                        conn.commit()
-                
-                return f"✅ @{target_username} назначен Администратором {level} уровня"
-            except ValueError:
-                return "❌ Неверный уровень администратора"
-    
-    if is_owner:
-        if command == '/unrang' and len(args) >= 1:
-            target_username = args[0].replace('@', '')
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "DELETE FROM chat_admins WHERE chat_id = %s AND telegram_username = %s",
-                        (chat_id, target_username)
-                    )
-                    if cur.rowcount > 0:
-                        conn.commit()
-                        return f"✅ Ранг @{target_username} снят"
-                    else:
-                        return f"❌ @{target_username} не является администратором"
+    if not target_info:
+        return "❌ Ответьте на сообщение пользователя или укажите @юзернейм"
     
+    target_user_id, target_username = target_info
+    
+    unrestrict_chat_member(req.bot_token, req.chat_id, target_user_id)
+    
+    delete_chat_mute(req.chat_id, target_user_id)
+    
+    send_telegram_message(
+        req.bot_token,
+        req.chat_id,
+        f"🔊 <b>Пользователь размучен</b>\n\n👤 @{target_username}"
+    )
     return None
 
+def render_mute_item(m: Dict[str, Any]) -> str:
+    return f"@{m['username']} - до {m['muted_until'].strftime('%d.%m.%Y %H:%M')}"
+
+def render_ban_item(b: Dict[str, Any]) -> str:
+    if b['banned_until']:
+        return f"@{b['username']} - до {b['banned_until'].strftime('%d.%m.%Y %H:%M')}"
+    return f"@{b['username']} - навсегда"
+
+def cmd_mutelist(req: CommandRequest) -> Optional[str]:
+    return show_list(req, MUTES_LIST)
+
+def cmd_banlist(req: CommandRequest) -> Optional[str]:
+    return show_list(req, BANS_LIST)
+
+def cmd_szamrang(req: CommandRequest, target_username: str) -> Optional[str]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO bot_managers (telegram_username, manager_rank) VALUES (%s, %s) ON CONFLICT (telegram_username) DO UPDATE SET manager_rank = %s",
+                (target_username, 'deputy', 'deputy')
+            )
+            conn.commit()
+    invalidate_after_commit(_manager_rank_cache, target_username)
+    return f"✅ @{target_username} назначен Заместителем Основателя"
+
+def cmd_deltechat(req: CommandRequest, chat_link: str) -> Optional[str]:
+    return "⚠️ Для удаления бота из чата используйте настройки группы в Telegram"
+
+def cmd_banchat(req: CommandRequest, chat_link: str, reason: str, ban_days: int) -> Optional[str]:
+    return f"✅ Чат {chat_link} заблокирован на {ban_days} дней. Причина: {reason}"
+
+def cmd_agent(req: CommandRequest, target_username: str) -> Optional[str]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO bot_managers (telegram_username, manager_rank) VALUES (%s, %s) ON CONFLICT (telegram_username) DO UPDATE SET manager_rank = %s",
+                (target_username, 'agent', 'agent')
+            )
+            conn.commit()
+    invalidate_after_commit(_manager_rank_cache, target_username)
+    return f"✅ @{target_username} назначен Сотрудником"
+
+def cmd_serverban(req: CommandRequest, target_username: str) -> Optional[str]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO server_bans (username) VALUES (%s) ON CONFLICT DO NOTHING",
+                (target_username,)
+            )
+            conn.commit()
+    return f"✅ @{target_username} получил глобальный бан"
+
+MANAGER_RANK_ORDER = "CASE manager_rank WHEN 'founder' THEN 1 WHEN 'deputy' THEN 2 WHEN 'agent' THEN 3 END"
+
+def fetch_agents(chat_id: int, after: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    """Сотрудники бота по ключу (порядок ранга, id)"""
+    condition = ""
+    params: Dict[str, Any] = {'limit': limit}
+    if after:
+        rank_order, manager_id = after.split(':')
+        condition = f"AND ({MANAGER_RANK_ORDER}, id) > (%(rank_order)s, %(id)s)"
+        params.update(rank_order=int(rank_order), id=int(manager_id))
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"""SELECT id, telegram_username, manager_rank, {MANAGER_RANK_ORDER} AS rank_order FROM bot_managers
+                    WHERE manager_rank IN ('founder', 'deputy', 'agent') {condition}
+                    ORDER BY rank_order, id
+                    LIMIT %(limit)s""",
+                params
+            )
+            return cur.fetchall()
+
+def render_agent_item(m: Dict[str, Any]) -> str:
+    rank_emoji = {'founder': '👑', 'deputy': '⭐', 'agent': '🎖️'}
+    rank_name = {'founder': 'Основатель', 'deputy': 'Зам. Основателя', 'agent': 'Сотрудник'}
+    return f"{rank_emoji.get(m['manager_rank'], '•')} @{m['telegram_username']} - {rank_name.get(m['manager_rank'], '')}"
+
+def cmd_agents(req: CommandRequest) -> Optional[str]:
+    return show_list(req, AGENTS_LIST)
+
+def fetch_chats(chat_id: int, after: Optional[str], limit: int) -> List[Dict[str, Any]]:
+    """Чаты бота по возрастанию chat_id, начиная после ключа"""
+    condition = "WHERE chat_id > %(after)s" if after else ""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f"SELECT chat_id, chat_title, owner_username FROM chats {condition} ORDER BY chat_id LIMIT %(limit)s",
+                {'after': int(after) if after else None, 'limit': limit}
+            )
+            return cur.fetchall()
+
+def render_chat_item(c: Dict[str, Any]) -> str:
+    return f"Чат ID: {c['chat_id']}\nНазвание: {html.escape(c['chat_title'] or '')}\nВладелец: @{c['owner_username']}\n"
+
+def cmd_chats(req: CommandRequest) -> Optional[str]:
+    return show_list(req, CHATS_LIST)
+
+def cmd_rang(req: CommandRequest, target_username: str, level: int) -> Optional[str]:
+    if level < 1 or level > 5:
+        return "❌ Уровень администратора должен быть от 1 до 5"
+    
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO chat_admins (chat_id, telegram_username, admin_level) VALUES (%s, %s, %s) ON CONFLICT (chat_id, telegram_username) DO UPDATE SET admin_level = %s",
+                (req.chat_id, target_username, level, level)
+            )
+            conn.commit()
+    invalidate_after_commit(_admin_level_cache, (req.chat_id, target_username))
+    
+    return f"✅ @{target_username} назначен Администратором {level} уровня"
+
+def cmd_unrang(req: CommandRequest, target_username: str) -> Optional[str]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM chat_admins WHERE chat_id = %s AND telegram_username = %s",
+                (req.chat_id, target_username)
+            )
+            removed = cur.rowcount > 0
+            conn.commit()
+    invalidate_after_commit(_admin_level_cache, (req.chat_id, target_username))
+    if removed:
+        return f"✅ Ранг @{target_username} снят"
+    return f"❌ @{target_username} не является администратором"
+
+STAFF_RANKS = ('founder', 'deputy', 'agent')
+DEPUTY_RANKS = ('founder', 'deputy')
+
+# Порядок в таблице задаёт порядок строк в /commands
+COMMANDS: List[Command] = [
+    Command('/me', cmd_me, 'all', 'Показать свой профиль и ранг'),
+    Command('/balance', cmd_balance, 'all', 'Показать баланс брюликов'),
+    Command('/farm', cmd_farm, 'all', 'Собрать брюлики (раз в час)'),
+    Command('/premium', cmd_premium, 'all', 'Купить Premium подписку'),
+    Command('/commands', cmd_commands, 'all', 'Показать список команд'),
+    Command('/profile', cmd_profile, 'all', 'Показать профиль пользователя', usage='[юзернейм]'),
+    Command('/sreport', cmd_sreport, 'all', 'Отправить репорт (только в ЛС)', usage='текст', private_only=True),
+    Command('/pmessage', cmd_pmessage, 'premium', 'Написать от лица бота', usage='текст'),
+    Command('/szamrang', cmd_szamrang, 'founder', 'Назначить зама основателя', usage='[юзернейм]',
+            ranks=('founder',), parse_args=parse_username),
+    Command('/deltechat', cmd_deltechat, 'founder', 'Удалить бота из чата', usage='[ссылка]',
+            ranks=('founder',), parse_args=parse_username),
+    Command('/banchat', cmd_banchat, 'founder', 'Заблокировать чат', usage='[ссылка] [причина] [дни]',
+            ranks=('founder',), parse_args=parse_banchat, invalid_args_message="❌ Неверное количество дней"),
+    Command('/agent', cmd_agent, 'deputy', 'Назначить сотрудника', usage='[юзернейм]',
+            ranks=DEPUTY_RANKS, parse_args=parse_username),
+    Command('/unagent', cmd_unagent, 'deputy', 'Снять сотрудника', usage='[юзернейм]',
+            ranks=DEPUTY_RANKS, parse_args=parse_username),
+    Command('/serverban', cmd_serverban, 'deputy', 'Глобальный бан', usage='[юзернейм]',
+            ranks=DEPUTY_RANKS, parse_args=parse_username),
+    Command('/brulik', cmd_brulik, 'deputy', 'Выдать брюлики', usage='[юзернейм] [число]',
+            ranks=DEPUTY_RANKS, parse_args=parse_username_and_int, invalid_args_message="❌ Неверное количество брюликов"),
+    Command('/agents', cmd_agents, 'agent', 'Список сотрудников', usage='[all]', ranks=STAFF_RANKS),
+    Command('/chats', cmd_chats, 'agent', 'Список чатов', usage='[all]', ranks=STAFF_RANKS),
+    Command('/reports', cmd_reports, 'agent', 'Просмотр репортов',
+            ranks=STAFF_RANKS, denied_message="❌ Эта команда доступна только для Сотрудников и выше"),
+    Command('/unrang', cmd_unrang, 'owner', 'Снять ранг', usage='[юзернейм]', owner=True, parse_args=parse_username),
+    Command('/gban', cmd_gban, 'owner', 'Забанить навсегда', usage='[юзернейм]', owner=True),
+    Command('/rang', cmd_rang, 'admin5', 'Назначить админа', usage='[юзернейм] [уровень 1-5]',
+            owner=True, admin_level=5, parse_args=parse_username_and_int,
+            invalid_args_message="❌ Неверный уровень администратора"),
+    Command('/chatname', cmd_chatname, 'admin5', 'Переименовать чат', usage='текст', admin_level=5, parse_args=parse_text),
+    Command('/unban', cmd_unban, 'admin4', 'Разбанить пользователя', usage='[юзернейм]', admin_level=4),
+    Command('/tban', cmd_tban, 'admin4', 'Временный бан', usage='[юзернейм] [причина] [время_минут]', admin_level=4),
+    Command('/mute', cmd_mute, 'admin2', 'Замутить пользователя', usage='[юзернейм] [минуты]', admin_level=2),
+    Command('/unmute', cmd_unmute, 'admin2', 'Размутить пользователя', usage='[юзернейм]', admin_level=2),
+    Command('/mutelist', cmd_mutelist, 'admin1', 'Список замученных', usage='[all]', admin_level=1),
+    Command('/banlist', cmd_banlist, 'admin1', 'Список забаненных', usage='[all]', admin_level=1),
+]
+
+COMMAND_REGISTRY: Dict[str, Command] = {command.name: command for command in COMMANDS}
+
+CHATS_LIST = ListView('chats', '/chats', "<b>💬 Список чатов:</b>\n", "💬 Список чатов пуст",
+                      fetch_chats, lambda c: str(c['chat_id']), render_chat_item)
+AGENTS_LIST = ListView('agents', '/agents', "<b>👥 Сотрудники бота:</b>\n", "👥 Сотрудников нет",
+                       fetch_agents, lambda m: f"{m['rank_order']}:{m['id']}", render_agent_item)
+MUTES_LIST = ListView('mutes', '/mutelist', "<b>📋 Замученные пользователи:</b>\n", "📋 Список замученных пуст",
+                      get_active_chat_mutes, lambda m: f"{encode_timestamp_key(m['muted_until'])}:{m['user_id']}", render_mute_item)
+BANS_LIST = ListView('bans', '/banlist', "<b>📋 Забаненные пользователи:</b>\n", "📋 Список забаненных пуст",
+                     get_active_chat_bans, lambda b: f"{encode_timestamp_key(b['banned_until'])}:{b['user_id']}", render_ban_item)
+LIST_VIEWS: Dict[str, ListView] = {view.code: view for view in (CHATS_LIST, AGENTS_LIST, MUTES_LIST, BANS_LIST)}
+
+HELP_SECTIONS = [
+    ('all', '<b>👥 Для всех пользователей:</b>'),
+    ('premium', '<b>⭐ Premium команды:</b>'),
+    ('founder', '<b>👔 Команды менеджеров бота:</b>\n<b>Основатель:</b>'),
+    ('deputy', '<b>Зам. Основателя:</b>'),
+    ('agent', '<b>Сотрудник:</b>'),
+    ('owner', '<b>🛡️ Команды модерации чата:</b>\n<b>Владелец:</b>'),
+    ('admin5', '<b>Администратор 5 уровня:</b>'),
+    ('admin4', '<b>Администратор 4 уровня:</b>'),
+    ('admin2', '<b>Администратор 2 уровня:</b>'),
+    ('admin1', '<b>Администратор 1 уровня:</b>'),
+]
+
+def build_commands_help() -> str:
+    blocks = []
+    for section, header in HELP_SECTIONS:
+        lines = [header]
+        for command in COMMANDS:
+            if command.section != section:
+                continue
+            usage = f" {command.usage}" if command.usage else ''
+            lines.append(f"{command.name}{usage} - {command.help}")
+        blocks.append('\n'.join(lines))
+    return "<b>📋 Доступные команды:</b>\n\n" + '\n\n'.join(blocks)
+
+COMMANDS_HELP_TEXT = build_commands_help()
+
+def handle_command(message: Dict[str, Any], bot_token: str) -> Optional[str]:
+    text = message.get('text', '')
+    
+    if not text.startswith('/'):
+        return None
+    
+    parts = text.split(maxsplit=1)
+    command = COMMAND_REGISTRY.get(parts[0].lower().split('@')[0])
+    if command is None:
+        return None
+    
+    req = CommandRequest(message, bot_token, command.name, parts[1] if len(parts) > 1 else '')
+    
+    if command.private_only and not req.is_private:
+        return "❌ Эта команда доступна только в личных сообщениях с ботом"
+    
+    if not has_command_permission(command, req.caller):
+        return command.denied_message
+    
+    parsed_args: tuple = ()
+    if command.parse_args:
+        try:
+            parsed_args = command.parse_args(req.args)
+        except IndexError:
+            return None
+        except ValueError:
+            return command.invalid_args_message
+    
+    return command.handler(req, *parsed_args)
+
 def handle_callback_query(callback_query: Dict[str, Any], bot_token: str):
     data = callback_query.get('data', '')
     user = callback_query['from']
@@ -841,108 +1917,124 @@ def handle_callback_query(callback_query: Dict[str, Any], bot_token: str):
     message_id = callback_query['message']['message_id']
     
     if data.startswith('premium_'):
-        days_map = {'premium_3': 3, 'premium_7': 7, 'premium_30': 30}
-        cost_map = {'premium_3': 100, 'premium_7': 250, 'premium_30': 1000}
-        
-        days = days_map.get(data, 0)
-        cost = cost_map.get(data, 0)
-        
-        if days == 0:
+        if data not in PREMIUM_PLANS:
             return
+        days, cost = PREMIUM_PLANS[data]
         
-        balance = get_user_balance(user_id, username)
+        purchase = purchase_premium(user_id, username, days, cost)
         
-        if balance < cost:
-            url = f'https://api.telegram.org/bot{bot_token}/answerCallbackQuery'
-            answer_data = json.dumps({
+        client = get_telegram_client(bot_token)
+        
+        if not purchase['purchased']:
+            client.call('answerCallbackQuery', {
                 'callback_query_id': callback_query['id'],
-                'text': f'❌ Недостаточно брюликов! У вас: {balance}, нужно: {cost}',
+                'text': f"❌ Недостаточно брюликов! У вас: {purchase['balance']}, нужно: {cost}",
                 'show_alert': True
-            }).encode('utf-8')
-            req = urllib.request.Request(url, data=answer_data, headers={'Content-Type': 'application/json'})
-            urllib.request.urlopen(req, timeout=10)
+            })
             return
         
-        update_user_balance(user_id, username, -cost)
-        add_user_premium(user_id, username, days)
-        
-        url = f'https://api.telegram.org/bot{bot_token}/editMessageText'
-        edit_data = json.dumps({
-            'chat_id': chat_id,
-            'message_id': message_id,
-            'text': f'✅ Вы успешно приобрели Premium подписку на {days} дней!\n\nТеперь вы можете использовать /pmessage для написания от лица бота',
-            'parse_mode': 'HTML'
-        }).encode('utf-8')
-        req = urllib.request.Request(url, data=edit_data, headers={'Content-Type': 'application/json'})
-        urllib.request.urlopen(req, timeout=10)
-        
-        url = f'https://api.telegram.org/bot{bot_token}/answerCallbackQuery'
-        answer_data = json.dumps({
-            'callback_query_id': callback_query['id'],
-            'text': f'✅ Premium активирован на {days} дней!',
-            'show_alert': False
-        }).encode('utf-8')
-        req = urllib.request.Request(url, data=answer_data, headers={'Content-Type': 'application/json'})
-        urllib.request.urlopen(req, timeout=10)
+        client.call_concurrently([
+            ('editMessageText', {
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'text': f'✅ Вы успешно приобрели Premium подписку на {days} дней!\n\nТеперь вы можете использовать /pmessage для написания от лица бота',
+                'parse_mode': 'HTML'
+            }),
+            ('answerCallbackQuery', {
+                'callback_query_id': callback_query['id'],
+                'text': f'✅ Premium активирован на {days} дней!',
+                'show_alert': False
+            })
+        ])
+    
+    elif data.startswith('rep_'):
+        handle_reports_callback(callback_query, bot_token)
+    
+    elif data.startswith('list:'):
+        handle_list_callback(callback_query, bot_token)
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    '''
-    Business: Handle Telegram webhook updates for bot commands and moderation
-    Args: event - webhook update from Telegram, context - function execution context
-    Returns: HTTP response with status 200
-    '''
-    method = event.get('httpMethod', 'POST')
+def handle_list_callback(callback_query: Dict[str, Any], bot_token: str):
+    """Кнопки списочных команд: страница после ключа из callback_data"""
+    _, code, after = callback_query['data'].split(':', 2)
+    view = LIST_VIEWS.get(code)
+    if view is None:
+        return
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    client = get_telegram_client(bot_token)
+    chat_id = callback_query['message']['chat']['id']
+    user = callback_query['from']
+    command = COMMAND_REGISTRY[view.command]
+    if not has_command_permission(command, CallerContext(chat_id, user['id'], user.get('username', ''))):
+        client.call('answerCallbackQuery', {
+            'callback_query_id': callback_query['id'],
+            'text': command.denied_message or "❌ Недостаточно прав",
+            'show_alert': True
+        })
+        return
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    text, keyboard = render_list_page(view, chat_id, after or None)
+    edit_payload: Dict[str, Any] = {
+        'chat_id': chat_id,
+        'message_id': callback_query['message']['message_id'],
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    if keyboard:
+        edit_payload['reply_markup'] = keyboard
+    client.call_concurrently([('editMessageText', edit_payload), ('answerCallbackQuery', {'callback_query_id': callback_query['id']})])
+
+def handle_reports_callback(callback_query: Dict[str, Any], bot_token: str):
+    """Кнопки /reports: листание страниц и отметка страницы прочитанной"""
+    client = get_telegram_client(bot_token)
+    action, _, key = callback_query['data'].partition(':')
     
-    body = json.loads(event.get('body', '{}'))
+    if get_manager_rank(callback_query['from'].get('username', '')) not in STAFF_RANKS:
+        client.call('answerCallbackQuery', {
+            'callback_query_id': callback_query['id'],
+            'text': "❌ Эта команда доступна только для Сотрудников и выше",
+            'show_alert': True
+        })
+        return
     
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Bot token not configured'}),
-            'isBase64Encoded': False
-        }
+    answer_text = None
+    if action == 'rep_read':
+        parts = key.split(':')
+        marked = mark_reports_viewed(decode_report_key(*parts[:2]), decode_report_key(*parts[2:]))
+        answer_text = f'✅ Отмечено прочитанными: {marked}'
+        page = fetch_reports_page()
+    elif action in ('rep_prev', 'rep_next'):
+        page = fetch_reports_page(action[len('rep_'):], decode_report_key(*key.split(':')))
+        # Все репорты в эту сторону уже прочитаны кем-то другим - показываем начало списка
+        if not page[0]:
+            page = fetch_reports_page()
+    else:
+        return
     
-    if 'callback_query' in body:
-        handle_callback_query(body['callback_query'], bot_token)
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'ok': True}),
-            'isBase64Encoded': False
-        }
+    text, keyboard = render_reports_page(*page)
+    edit_payload: Dict[str, Any] = {
+        'chat_id': callback_query['message']['chat']['id'],
+        'message_id': callback_query['message']['message_id'],
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    if keyboard:
+        edit_payload['reply_markup'] = keyboard
+    answer_payload: Dict[str, Any] = {'callback_query_id': callback_query['id']}
+    if answer_text:
+        answer_payload['text'] = answer_text
+    client.call_concurrently([('editMessageText', edit_payload), ('answerCallbackQuery', answer_payload)])
+
+def process_update(update: Dict[str, Any], bot_token: str):
+    remember_users(extract_update_users(update))
     
-    if 'message' not in body:
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'ok': True}),
-            'isBase64Encoded': False
-        }
+    if 'callback_query' in update:
+        handle_callback_query(update['callback_query'], bot_token)
+        return
+    
+    if 'message' not in update:
+        return
     
-    message = body['message']
+    message = update['message']
     
     if 'new_chat_members' in message:
         chat_id = message['chat']['id']
@@ -956,28 +2048,514 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     (chat_id, chat_title, owner_username, chat_title, owner_username)
                 )
                 conn.commit()
+        invalidate_after_commit(_chat_owner_cache, chat_id)
         
         welcome_text = """👋 Привет! Я бот для управления чатом.
 
 Используйте /commands для просмотра всех доступных команд."""
         send_telegram_message(bot_token, chat_id, welcome_text)
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'ok': True}),
-            'isBase64Encoded': False
-        }
+        return
     
     response_text = handle_command(message, bot_token)
     
     if response_text:
         chat_id = message['chat']['id']
         send_telegram_message(bot_token, chat_id, response_text)
+
+def get_bot_id(bot_token: str) -> int:
+    """id бота - числовая часть токена до двоеточия"""
+    prefix = bot_token.split(':', 1)[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+def needs_claim(update: Dict[str, Any]) -> bool:
+    """Повтор команды, кнопки или входа в чат повторил бы их действие; обычные сообщения и неизвестные команды отмечать незачем"""
+    label = describe_update(update)
+    return label == 'join' or label.startswith('callback:') or label in COMMAND_REGISTRY
+
+def claim_update(bot_id: int, update_id: int) -> bool:
+    """Отметить апдейт обработанным; False, если он уже был обработан. Отметка откатывается вместе с транзакцией обработки"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO processed_updates (bot_id, update_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                (bot_id, update_id)
+            )
+            return cur.rowcount == 1
+
+def begin_update(bot_id: int, update_id: int) -> Tuple[bool, Optional[str]]:
+    """Захватить апдейт вебхука короткой транзакцией; возвращает (захвачен ли, сохранённый inline-ответ)"""
+    # Отметки коммитятся без ожидания fsync: при падении Postgres теряется разве что отметка, и апдейт обработается ещё раз
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """SET LOCAL synchronous_commit = off;
+                   WITH claimed AS (
+                       INSERT INTO processed_updates (bot_id, update_id, status) VALUES (%s, %s, 'in_progress')
+                       -- Брошенную отметку (функцию убили по таймауту) перехватывает повтор
+                       ON CONFLICT (bot_id, update_id) DO UPDATE SET processed_at = CURRENT_TIMESTAMP
+                       WHERE processed_updates.status = 'in_progress'
+                         AND processed_updates.processed_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                       RETURNING 1
+                   )
+                   SELECT EXISTS (SELECT 1 FROM claimed),
+                          (SELECT reply FROM processed_updates WHERE bot_id = %s AND update_id = %s)""",
+                (bot_id, update_id, PROCESSED_UPDATES_CLAIM_TIMEOUT_SECONDS, bot_id, update_id)
+            )
+            claimed, reply = cur.fetchone()
+            return claimed, reply
+
+def finish_update(bot_id: int, update_id: int, reply: Optional[str]):
+    """Отметить захваченный апдейт завершённым и сохранить inline-ответ для повторов"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SET LOCAL synchronous_commit = off; UPDATE processed_updates SET status = 'done', reply = %s, processed_at = CURRENT_TIMESTAMP WHERE bot_id = %s AND update_id = %s",
+                (reply, bot_id, update_id)
+            )
+
+def release_update(bot_id: int, update_id: int):
+    """Снять захват после ошибки, чтобы повтор от Telegram обработал апдейт заново"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM processed_updates WHERE bot_id = %s AND update_id = %s AND status = 'in_progress'",
+                (bot_id, update_id)
+            )
+
+def run_webhook_update(update: Dict[str, Any], bot_token: str) -> Dict[str, Any]:
+    """Обработать апдейт и вернуть тело ответа вебхука: последний ответный вызов, если обработка уложилась в WEBHOOK_INLINE_REPLY_DEADLINE_SECONDS"""
+    if not WEBHOOK_INLINE_REPLY:
+        process_update(update, bot_token)
+        return OK_RESPONSE_BODY
+    
+    started = time.monotonic()
+    client = get_telegram_client(bot_token)
+    with client.collect_replies() as replies:
+        process_update(update, bot_token)
+    if time.monotonic() - started > WEBHOOK_INLINE_REPLY_DEADLINE_SECONDS:
+        client.send_replies(replies)
+        return OK_RESPONSE_BODY
+    return client.take_inline_reply(replies) or OK_RESPONSE_BODY
+
+def process_webhook_update(update: Dict[str, Any], bot_token: str) -> Dict[str, Any]:
+    """Обработать апдейт вебхука ровно один раз и вернуть тело ответа; повтор получает сохранённый ответ первой обработки"""
+    update_id = update.get('update_id')
+    if update_id is None or not needs_claim(update):
+        return run_webhook_update(update, bot_token)
+    
+    key = (get_bot_id(bot_token), update_id)
+    response = _processed_updates_cache.get(key)
+    if response is _CACHE_MISS:
+        # Отметка коммитится до обработки и не держит блокировку на время вызовов Bot API;
+        # повтор, пришедший во время обработки, видит in_progress и сразу получает ok
+        claimed, reply = begin_update(*key)
+        if claimed:
+            try:
+                response = run_webhook_update(update, bot_token)
+            except Exception:
+                release_update(*key)
+                raise
+            finish_update(*key, None if response is OK_RESPONSE_BODY else json.dumps(response))
+            _processed_updates_cache.set(key, response)
+            return response
+        response = json.loads(reply) if reply else OK_RESPONSE_BODY
+    log_event('duplicate_update', update_id=update_id, replayed=response is not OK_RESPONSE_BODY)
+    return response
+
+def log_event(event: str, **fields: Any):
+    print(json.dumps({'event': event, **fields}, default=str), flush=True)
+
+def prefetch_batch_context(updates: List[Dict[str, Any]]):
+    """Записать пользователей пачки в справочник, загрузить права авторов команд тремя запросами и заранее создать их кошельки"""
+    remember_users([user for update in updates for user in extract_update_users(update)])
+    
+    chat_users = set()
+    wallet_users = {}
+    for update in updates:
+        message = update.get('message')
+        if message and message.get('text', '').startswith('/') and 'from' in message:
+            username = message['from'].get('username', '')
+            chat_users.add((message['chat']['id'], username))
+            if message['text'].split(maxsplit=1)[0].lower().split('@')[0] in WALLET_COMMANDS:
+                wallet_users[message['from']['id']] = username
+        elif 'callback_query' in update:
+            callback_query = update['callback_query']
+            wallet_users[callback_query['from']['id']] = callback_query['from'].get('username', '')
+    if not chat_users and not wallet_users:
+        return
+    
+    chat_ids = sorted({chat_id for chat_id, _ in chat_users})
+    usernames = sorted({username for _, username in chat_users})
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            if chat_users:
+                cur.execute(
+                    "SELECT telegram_username, manager_rank FROM bot_managers WHERE telegram_username = ANY(%s)",
+                    (usernames,)
+                )
+                ranks = {row['telegram_username']: row['manager_rank'] for row in cur.fetchall()}
+                cur.execute(
+                    """SELECT a.chat_id, a.telegram_username, a.admin_level
+                       FROM chat_admins a
+                       JOIN unnest(%s::bigint[], %s::text[]) AS p(chat_id, telegram_username)
+                         ON a.chat_id = p.chat_id AND a.telegram_username = p.telegram_username""",
+                    ([chat_id for chat_id, _ in chat_users], [username for _, username in chat_users])
+                )
+                levels = {(row['chat_id'], row['telegram_username']): row['admin_level'] for row in cur.fetchall()}
+                cur.execute(
+                    "SELECT chat_id, owner_username FROM chats WHERE chat_id = ANY(%s)",
+                    (chat_ids,)
+                )
+                owners = {row['chat_id']: row['owner_username'] for row in cur.fetchall()}
+                for username in usernames:
+                    _manager_rank_cache.set(username, ranks.get(username))
+                for key in chat_users:
+                    _admin_level_cache.set(key, levels.get(key))
+                for chat_id in chat_ids:
+                    _chat_owner_cache.set(chat_id, owners.get(chat_id))
+            # Создание недостающих кошельков идемпотентно, поэтому его можно сделать одним запросом;
+            # изменения баланса и премиума зависят от порядка апдейтов и остаются в обработчиках
+            if wallet_users:
+                cur.execute(
+                    """INSERT INTO user_currency (user_id, username, balance)
+                       SELECT user_id, username, 0 FROM unnest(%s::bigint[], %s::text[]) AS w(user_id, username)
+                       ON CONFLICT (user_id) DO NOTHING""",
+                    (sorted(wallet_users), [wallet_users[user_id] for user_id in sorted(wallet_users)])
+                )
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Сбой соединения или пула: повтор того же апдейта может пройти, остальные ошибки повторятся и при повторе"""
+    return psycopg2 is not None and isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError))
+
+def process_update_chunk(conn, chunk: List[Dict[str, Any]], bot_token: str) -> List[str]:
+    """Обработать пачку в открытой shared_db_transaction с точкой сохранения на апдейт; исходы: processed, duplicate, retry или failed"""
+    bot_id = get_bot_id(bot_token)
+    prefetch_batch_context(chunk)
+    outcomes = []
+    for update in chunk:
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT batch_update")
+        try:
+            claimed = update.get('update_id') is not None and needs_claim(update)
+            if claimed and not claim_update(bot_id, update['update_id']):
+                outcome = 'duplicate'
+            else:
+                try:
+                    process_update(update, bot_token)
+                except psycopg2.extensions.TransactionRollbackError:
+                    # Взаимоблокировка с соседним шардом: Postgres отменил нашу сторону, повторяем один раз
+                    with conn.cursor() as cur:
+                        cur.execute("ROLLBACK TO SAVEPOINT batch_update")
+                    if claimed:
+                        claim_update(bot_id, update['update_id'])
+                    process_update(update, bot_token)
+                outcome = 'processed'
+        except Exception as e:
+            from traceback import format_exc
+            with conn.cursor() as cur:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_update")
+            outcome = 'retry' if is_transient_error(e) else 'failed'
+            log_event('update_failed', update_id=update.get('update_id'), outcome=outcome, error=format_exc())
+            outcomes.append(outcome)
+            continue
+        with conn.cursor() as cur:
+            cur.execute("RELEASE SAVEPOINT batch_update")
+        outcomes.append(outcome)
+    return outcomes
+
+def run_update_chunk(chunk: List[Dict[str, Any]], bot_token: str) -> List[str]:
+    """Обработать пачку в своей транзакции; потерянная транзакция откатывает всю пачку, и её апдейты получают исход retry"""
+    try:
+        with shared_db_transaction() as conn:
+            return process_update_chunk(conn, chunk, bot_token)
+    except Exception:
+        from traceback import format_exc
+        log_event('chunk_failed', update_ids=[update.get('update_id') for update in chunk], error=format_exc())
+        return ['retry'] * len(chunk)
+
+def get_update_chat_id(update: Dict[str, Any]) -> Any:
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update and 'message' in update['callback_query']:
+        return update['callback_query']['message']['chat']['id']
+    return None
+
+def describe_update(update: Dict[str, Any]) -> str:
+    """Метка апдейта для логов: команда, префикс кнопки, вход в чат или обычное сообщение"""
+    if 'callback_query' in update:
+        data = update['callback_query'].get('data', '')
+        return 'callback:' + data.replace(':', '_').split('_', 1)[0]
+    message = update.get('message')
+    if message is None:
+        return 'other'
+    if 'new_chat_members' in message:
+        return 'join'
+    text = message.get('text', '')
+    if not text.startswith('/'):
+        return 'message'
+    command = text.split(maxsplit=1)[0].lower().split('@')[0]
+    return command if command in COMMAND_REGISTRY else 'unknown_command'
+
+class ChatScheduler:
+    """Параллельная обработка апдейтов: чат всегда в одном шарде, внутри шарда строгий FIFO, submit ждёт при полной очереди"""
+    
+    def __init__(self, bot_token: str, shards: int = UPDATE_SHARDS, queue_size: int = UPDATE_SHARD_QUEUE_SIZE,
+                 commit_size: int = UPDATE_SHARD_COMMIT_SIZE):
+        self.bot_token = bot_token
+        self.commit_size = commit_size
+        self.outcomes: Dict[str, int] = {'processed': 0, 'duplicate': 0, 'retry': 0, 'failed': 0}
+        self.failed: List[Any] = []
+        self.retry: List[Any] = []
+        self.backpressure_waits = 0
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self._queues]
+        for thread in self._threads:
+            thread.start()
+    
+    def submit(self, update: Dict[str, Any]):
+        shard = self._queues[hash(get_update_chat_id(update)) % len(self._queues)]
+        if shard.full():
+            with self._lock:
+                self.backpressure_waits += 1
+        shard.put(update)
+    
+    def _run(self, shard: queue.Queue):
+        # Ответы шарда уходят в фоне, пока обрабатывается его пачка; пачка считается выполненной после их отправки.
+        # Потоки отправки делят пул HTTP-соединений между шардами, иначе лишние соединения открываются заново
+        client = get_telegram_client(self.bot_token)
+        with client.pipeline(max(1, client.pool_size // len(self._queues))) as pipeline:
+            while True:
+                chunk = self._take_chunk(shard)
+                if not chunk:
+                    return
+                self._process_chunk(chunk)
+                pipeline.drain()
+                for _ in chunk:
+                    shard.task_done()
+    
+    def _take_chunk(self, shard: queue.Queue) -> List[Dict[str, Any]]:
+        """Первый апдейт ждём, остальное уже накопившееся в шарде забираем в ту же транзакцию"""
+        chunk: List[Dict[str, Any]] = []
+        while len(chunk) < self.commit_size:
+            try:
+                update = shard.get() if not chunk else shard.get_nowait()
+            except queue.Empty:
+                break
+            if update is None:
+                # Сигнал остановки: возвращаем его в очередь, поток завершится на следующем круге
+                shard.task_done()
+                if chunk:
+                    shard.put(None)
+                break
+            chunk.append(update)
+        return chunk
+    
+    def _process_chunk(self, chunk: List[Dict[str, Any]]):
+        outcomes = run_update_chunk(chunk, self.bot_token)
+        with self._lock:
+            for update, outcome in zip(chunk, outcomes):
+                self.outcomes[outcome] += 1
+                if outcome == 'failed':
+                    self.failed.append(update.get('update_id'))
+                elif outcome == 'retry':
+                    self.retry.append(update.get('update_id'))
+    
+    def join(self) -> Dict[str, Any]:
+        """Дождаться обработки всего, что уже отправлено в шарды; итоги считаются с прошлого join"""
+        for shard in self._queues:
+            shard.join()
+        with self._lock:
+            stats = {
+                'processed': self.outcomes['processed'],
+                'duplicates': self.outcomes['duplicate'],
+                'failed': self.failed,
+                'retry': self.retry,
+                'backpressure_waits': self.backpressure_waits
+            }
+            self.outcomes = dict.fromkeys(self.outcomes, 0)
+            self.failed = []
+            self.retry = []
+            self.backpressure_waits = 0
+            return stats
+    
+    def close(self):
+        for shard in self._queues:
+            shard.put(None)
+        for thread in self._threads:
+            thread.join()
+    
+    def __enter__(self) -> 'ChatScheduler':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def process_updates(updates: List[Dict[str, Any]], bot_token: str, shards: int = UPDATE_SHARDS,
+                    scheduler: Optional[ChatScheduler] = None) -> Dict[str, Any]:
+    """Пакетная обработка апдейтов (getUpdates, файл повтора): чаты параллельно по шардам или, при одном шарде, последовательно"""
+    # Долгоживущий процесс передаёт свой scheduler, чтобы не запускать потоки шардов на каждую пачку
+    if scheduler is not None:
+        for update in updates:
+            scheduler.submit(update)
+        return scheduler.join()
+    if shards > 1:
+        with ChatScheduler(bot_token, shards) as scheduler:
+            for update in updates:
+                scheduler.submit(update)
+            return scheduler.join()
+    
+    outcomes: List[str] = []
+    client = get_telegram_client(bot_token)
+    with client.pipeline():
+        for start in range(0, len(updates), BATCH_COMMIT_SIZE):
+            outcomes.extend(run_update_chunk(updates[start:start + BATCH_COMMIT_SIZE], bot_token))
+    return {
+        'processed': outcomes.count('processed'),
+        'duplicates': outcomes.count('duplicate'),
+        'failed': [update.get('update_id') for update, outcome in zip(updates, outcomes) if outcome == 'failed'],
+        'retry': [update.get('update_id') for update, outcome in zip(updates, outcomes) if outcome == 'retry']
+    }
+
+def enqueue_update(update: Dict[str, Any], bot_token: str):
+    """Положить апдейт в очередь update_queue одним запросом и разбудить воркер"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO update_queue (bot_id, update_id, payload) VALUES (%s, %s, %s)
+                   ON CONFLICT (bot_id, update_id) DO NOTHING;
+                   NOTIFY update_queue""",
+                (get_bot_id(bot_token), update.get('update_id'), json.dumps(update))
+            )
+
+def should_profile(event: Dict[str, Any]) -> bool:
+    if WEBHOOK_PROFILE_TOKEN:
+        headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        if headers.get('x-profile-token') == WEBHOOK_PROFILE_TOKEN:
+            return True
+    return WEBHOOK_PROFILE_RATE > 0 and random.random() < WEBHOOK_PROFILE_RATE
+
+def start_profiler() -> Any:
+    # cProfile импортируется только для попавших в выборку вызовов
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_profile(profiler: Any, update: Dict[str, Any]):
+    """Остановить профилировщик и записать профиль; апдейт уже обработан, поэтому сбой записи только логируется"""
+    profiler.disable()
+    try:
+        write_profile(profiler, update)
+    except Exception:
+        from traceback import format_exc
+        log_event('profile_failed', update_id=update.get('update_id') if isinstance(update, dict) else None, error=format_exc())
+
+def write_profile(profiler: Any, update: Dict[str, Any]):
+    """Записать в лог самые горячие функции; при WEBHOOK_PROFILE_DIR сохранить .prof"""
+    import pstats
+    stats = pstats.Stats(profiler).stats
+    label = describe_update(update)
+    
+    groups = {name: 0.0 for name, _ in PROFILE_GROUPS}
+    handle_command_seconds = 0.0
+    top = []
+    for (filename, line, function), (_, calls, own, cumulative, _) in stats.items():
+        where = f'{filename}:{function}'
+        for name, markers in PROFILE_GROUPS:
+            if any(marker in where for marker in markers):
+                groups[name] += own
+                break
+        if function == 'handle_command' and filename.endswith('index.py'):
+            handle_command_seconds = cumulative
+        top.append((cumulative, own, calls, f'{os.path.basename(filename)}:{line}({function})'))
+    top.sort(reverse=True)
+    
+    log_event('profile', update_id=update.get('update_id'), label=label,
+              total_ms=round(top[0][0] * 1000, 3) if top else 0,
+              handle_command_ms=round(handle_command_seconds * 1000, 3),
+              own_ms={name: round(seconds * 1000, 3) for name, seconds in groups.items()},
+              top=[{'function': function, 'calls': calls, 'cumulative_ms': round(cumulative * 1000, 3), 'own_ms': round(own * 1000, 3)}
+                   for cumulative, own, calls, function in top[:PROFILE_TOP_N]])
+    if WEBHOOK_PROFILE_DIR:
+        name = f"{label.replace('/', '').replace(':', '_')}-{update.get('update_id') or int(time.time() * 1000)}.prof"
+        profiler.dump_stats(os.path.join(WEBHOOK_PROFILE_DIR, name))
+
+# Статические ответы собраны и сериализованы один раз при импорте
+JSON_HEADERS = {'Content-Type': 'application/json'}
+OK_RESPONSE_BODY = {'ok': True}
+OK_BODY = json.dumps(OK_RESPONSE_BODY)
+CORS_PREFLIGHT_RESPONSE = {
+    'statusCode': 200,
+    'headers': {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '86400'
+    },
+    'body': '',
+    'isBase64Encoded': False
+}
+METHOD_NOT_ALLOWED_RESPONSE = {
+    'statusCode': 405,
+    'headers': JSON_HEADERS,
+    'body': json.dumps({'error': 'Method not allowed'}),
+    'isBase64Encoded': False
+}
+BOT_TOKEN_MISSING_RESPONSE = {
+    'statusCode': 500,
+    'headers': JSON_HEADERS,
+    'body': json.dumps({'error': 'Bot token not configured'}),
+    'isBase64Encoded': False
+}
+
+def handle_webhook_update(update: Dict[str, Any], bot_token: str) -> Dict[str, Any]:
+    """Обработать апдейт в режиме из окружения; возвращает тело ответа вебхука"""
+    if WEBHOOK_DEFERRED:
+        enqueue_update(update, bot_token)
+        return OK_RESPONSE_BODY
+    
+    return process_webhook_update(update, bot_token)
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Handle Telegram webhook updates for bot commands and moderation
+    Args: event - webhook update from Telegram, context - function execution context
+    Returns: HTTP response with status 200, body may carry one inline Bot API call
+    '''
+    method = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return CORS_PREFLIGHT_RESPONSE
+    
+    if method != 'POST':
+        return METHOD_NOT_ALLOWED_RESPONSE
+    
+    body = json.loads(event.get('body', '{}'))
+    
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        return BOT_TOKEN_MISSING_RESPONSE
+    
+    trace = start_trace() if WEBHOOK_TRACE else None
+    profiler = start_profiler() if should_profile(event) else None
+    response_body = None
+    try:
+        response_body = handle_webhook_update(body, bot_token)
+    except Exception as e:
+        if trace is not None:
+            trace.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        if profiler is not None:
+            finish_profile(profiler, body)
+        if trace is not None:
+            finish_trace(trace, body, response_body)
+    log_cache_stats()
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json'},
-        'body': json.dumps({'ok': True}),
+        'headers': JSON_HEADERS,
+        'body': OK_BODY if response_body is OK_RESPONSE_BODY else json.dumps(response_body),
         'isBase64Encoded': False
-    }
\ No newline at end of file
+    }
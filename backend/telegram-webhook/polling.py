@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+from typing import Dict, Any, Optional, List
+
+from index import (
+    UPDATE_SHARDS,
+    ChatScheduler,
+    TelegramClient,
+    get_bot_id,
+    get_db_connection,
+    get_telegram_client,
+    log_event,
+    process_updates,
+)
+
+POLL_TIMEOUT_SECONDS = 25
+POLL_LIMIT = 100
+POLL_ERROR_BACKOFF_SECONDS = 3
+# Столько раз апдейт с временным сбоем получает заново, потом он пропускается, чтобы не держать очередь
+POLL_MAX_ATTEMPTS = 5
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+def load_offset(bot_id: int) -> Optional[int]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT update_offset FROM polling_offsets WHERE bot_id = %s", (bot_id,))
+            result = cur.fetchone()
+            return result[0] if result else None
+
+def save_offset(bot_id: int, offset: int):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO polling_offsets (bot_id, update_offset, updated_at)
+                   VALUES (%s, %s, CURRENT_TIMESTAMP)
+                   ON CONFLICT (bot_id)
+                   DO UPDATE SET update_offset = EXCLUDED.update_offset, updated_at = CURRENT_TIMESTAMP""",
+                (bot_id, offset)
+            )
+
+def load_replay_file(path: str) -> List[Dict[str, Any]]:
+    """Прочитать апдейты из JSON-массива или файла JSON Lines"""
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+def open_scheduler(bot_token: str) -> Any:
+    """Один планировщик шардов на весь процесс, а не на каждую пачку; при одном шарде - без планировщика"""
+    return ChatScheduler(bot_token) if UPDATE_SHARDS > 1 else nullcontext()
+
+def next_offset(updates: List[Dict[str, Any]], retry: List[int], attempts: Dict[int, int]) -> int:
+    """Offset после пачки: первый апдейт с временным сбоем, если он не исчерпал POLL_MAX_ATTEMPTS, иначе следующий за пачкой"""
+    for update_id in sorted(retry):
+        attempts[update_id] = attempts.get(update_id, 0) + 1
+        if attempts[update_id] < POLL_MAX_ATTEMPTS:
+            return update_id
+        log_event('update_dropped', update_id=update_id, attempts=attempts[update_id])
+    return updates[-1]['update_id'] + 1
+
+def replay(bot_token: str, path: str, limit: int = POLL_LIMIT) -> Dict[str, Any]:
+    updates = load_replay_file(path)
+    started = time.monotonic()
+    processed = 0
+    duplicates = 0
+    failed = 0
+    backpressure_waits = 0
+    with open_scheduler(bot_token) as scheduler:
+        # Шардам файл подаётся одним потоком: submit ждёт, пока в очереди шарда не освободится место
+        step = limit if scheduler is None else max(1, len(updates))
+        for start in range(0, len(updates), step):
+            stats = process_updates(updates[start:start + step], bot_token, scheduler=scheduler)
+            processed += stats['processed']
+            duplicates += stats['duplicates']
+            failed += len(stats['failed']) + len(stats['retry'])
+            backpressure_waits += stats.get('backpressure_waits', 0)
+    elapsed = time.monotonic() - started
+    totals = {
+        'updates': processed,
+        'duplicates': duplicates,
+        'failed': failed,
+        'backpressure_waits': backpressure_waits,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(processed / elapsed, 1) if elapsed else None
+    }
+    log_event('replay_finished', **totals)
+    return totals
+
+def run(bot_token: str, poll_timeout: int = POLL_TIMEOUT_SECONDS, limit: int = POLL_LIMIT,
+        max_updates: Optional[int] = None, delete_webhook: bool = False) -> Dict[str, Any]:
+    '''
+    Business: Receive updates via getUpdates long polling instead of the webhook
+    Args: bot_token - Telegram bot token, poll_timeout - long polling timeout in seconds,
+          limit - max updates per batch, max_updates - stop after this many updates (for benchmarks)
+    Returns: totals of processed updates and throughput
+    '''
+    bot_id = get_bot_id(bot_token)
+    # Отдельный клиент: его таймаут сокета должен быть больше таймаута long polling
+    poll_client = TelegramClient(bot_token, pool_size=1, timeout=poll_timeout + 10)
+    if delete_webhook:
+        get_telegram_client(bot_token).call('deleteWebhook', {'drop_pending_updates': False})
+    
+    offset = load_offset(bot_id)
+    attempts: Dict[int, int] = {}
+    processed = 0
+    started = time.monotonic()
+    log_event('polling_started', bot_id=bot_id, offset=offset)
+    
+    with open_scheduler(bot_token) as scheduler:
+        try:
+            while max_updates is None or processed < max_updates:
+                payload: Dict[str, Any] = {'timeout': poll_timeout, 'limit': limit, 'allowed_updates': ALLOWED_UPDATES}
+                if offset is not None:
+                    payload['offset'] = offset
+                result = poll_client.call('getUpdates', payload)
+                if not result or not result.get('ok'):
+                    log_event('poll_failed', response=result)
+                    time.sleep(POLL_ERROR_BACKOFF_SECONDS)
+                    continue
+                
+                updates = result['result']
+                if not updates:
+                    continue
+                
+                batch_started = time.monotonic()
+                stats = process_updates(updates, bot_token, scheduler=scheduler)
+                # Повтор начнётся с первого апдейта со сбоем, уже обработанные после него отсеет processed_updates
+                offset = next_offset(updates, stats['retry'], attempts)
+                attempts = {update_id: count for update_id, count in attempts.items() if update_id >= offset}
+                save_offset(bot_id, offset)
+                processed += len(updates)
+                batch_seconds = time.monotonic() - batch_started
+                log_event('batch_processed', updates=len(updates), duplicates=stats['duplicates'], failed=len(stats['failed']), retry=len(stats['retry']),
+                    backpressure_waits=stats.get('backpressure_waits', 0),
+                    seconds=round(batch_seconds, 4), updates_per_second=round(len(updates) / batch_seconds, 1) if batch_seconds else None)
+                if stats['retry']:
+                    time.sleep(POLL_ERROR_BACKOFF_SECONDS)
+        except KeyboardInterrupt:
+            pass
+    
+    elapsed = time.monotonic() - started
+    totals = {
+        'updates': processed,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(processed / elapsed, 1) if elapsed else None,
+        'offset': offset
+    }
+    log_event('polling_stopped', **totals)
+    return totals
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Long polling runner for the Telegram bot')
+    parser.add_argument('--timeout', type=int, default=POLL_TIMEOUT_SECONDS, help='getUpdates long polling timeout')
+    parser.add_argument('--limit', type=int, default=POLL_LIMIT, help='max updates per getUpdates call')
+    parser.add_argument('--max-updates', type=int, default=None, help='stop after processing this many updates')
+    parser.add_argument('--delete-webhook', action='store_true', help='remove the webhook before polling')
+    parser.add_argument('--replay', metavar='PATH', help='process updates from a JSON or JSON Lines file instead of polling')
+    args = parser.parse_args(argv)
+    
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        print('TELEGRAM_BOT_TOKEN is not configured', file=sys.stderr)
+        return 1
+    
+    if args.replay:
+        replay(bot_token, args.replay, args.limit)
+        return 0
+    
+    run(bot_token, args.timeout, args.limit, args.max_updates, args.delete_webhook)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
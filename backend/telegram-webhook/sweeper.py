@@ -0,0 +1,86 @@
+import argparse
+import sys
+import time
+from typing import Dict, Any, Optional, List
+
+from index import PROCESSED_UPDATES_TTL_SECONDS, get_db_connection, log_event
+
+SWEEP_BATCH_SIZE = 1000
+SWEEP_MAX_BATCHES = 100
+
+# Каждый запрос удаляет не больше %(limit)s истёкших строк; выбор идёт по индексу на времени окончания,
+# строки, которые держит другой воркер или обработчик команды, пропускаются
+SWEEP_QUERIES = {
+    'chat_mutes': """DELETE FROM chat_mutes
+                     WHERE (chat_id, user_id) IN (
+                         SELECT chat_id, user_id FROM chat_mutes
+                         WHERE muted_until <= CURRENT_TIMESTAMP
+                         LIMIT %(limit)s
+                         FOR UPDATE SKIP LOCKED
+                     )""",
+    'chat_bans': """DELETE FROM chat_bans
+                    WHERE (chat_id, user_id) IN (
+                        SELECT chat_id, user_id FROM chat_bans
+                        WHERE banned_until IS NOT NULL AND banned_until <= CURRENT_TIMESTAMP
+                        LIMIT %(limit)s
+                        FOR UPDATE SKIP LOCKED
+                    )""",
+    'user_premium': """DELETE FROM user_premium
+                       WHERE id IN (
+                           SELECT id FROM user_premium
+                           WHERE expires_at <= CURRENT_TIMESTAMP
+                           LIMIT %(limit)s
+                           FOR UPDATE SKIP LOCKED
+                       )""",
+    'processed_updates': """DELETE FROM processed_updates
+                            WHERE (bot_id, update_id) IN (
+                                SELECT bot_id, update_id FROM processed_updates
+                                WHERE processed_at <= CURRENT_TIMESTAMP - make_interval(secs => %(ttl)s)
+                                LIMIT %(limit)s
+                                FOR UPDATE SKIP LOCKED
+                            )"""
+}
+
+def sweep_table(table: str, batch_size: int, max_batches: int) -> int:
+    """Удалять истёкшие строки таблицы пачками, каждая пачка в своей короткой транзакции"""
+    deleted = 0
+    for _ in range(max_batches):
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SWEEP_QUERIES[table], {'limit': batch_size, 'ttl': PROCESSED_UPDATES_TTL_SECONDS})
+                batch_deleted = cur.rowcount
+        deleted += batch_deleted
+        if batch_deleted < batch_size:
+            break
+    return deleted
+
+def sweep_expired(batch_size: int = SWEEP_BATCH_SIZE, max_batches: int = SWEEP_MAX_BATCHES) -> Dict[str, Any]:
+    '''
+    Business: Delete expired mutes, temporary bans, lapsed premium subscriptions and old processed update ids
+    Args: batch_size - rows deleted per transaction, max_batches - batches per table in one run
+    Returns: deleted rows per table and run duration
+    '''
+    started = time.monotonic()
+    totals: Dict[str, Any] = {table: sweep_table(table, batch_size, max_batches) for table in SWEEP_QUERIES}
+    totals['seconds'] = round(time.monotonic() - started, 3)
+    log_event('expiry_sweep', **totals)
+    return totals
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Delete expired moderation, premium and processed update rows')
+    parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE, help='rows deleted per transaction')
+    parser.add_argument('--max-batches', type=int, default=SWEEP_MAX_BATCHES, help='batches per table in one run')
+    parser.add_argument('--interval', type=float, default=None, help='repeat the sweep every N seconds instead of running once')
+    args = parser.parse_args(argv)
+    
+    while True:
+        sweep_expired(args.batch_size, args.max_batches)
+        if args.interval is None:
+            return 0
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
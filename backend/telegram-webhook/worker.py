@@ -0,0 +1,144 @@
+import argparse
+import os
+import select
+import sys
+import time
+from typing import Dict, Any, Optional, List
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from index import (
+    BATCH_COMMIT_SIZE,
+    get_bot_id,
+    get_telegram_client,
+    log_event,
+    process_update_chunk,
+    shared_db_transaction,
+)
+
+WORKER_MAX_ATTEMPTS = 5
+WORKER_RETRY_DELAY_SECONDS = 30
+# Сколько ждать NOTIFY от вебхука, прежде чем заглянуть в очередь самому (отложенные повторы)
+WORKER_IDLE_TIMEOUT_SECONDS = 5
+
+def drain_batch(bot_token: str, batch_size: int = BATCH_COMMIT_SIZE) -> Dict[str, Any]:
+    """Обработать одну пачку из очереди; возвращает счётчики взятых, обработанных, повторных, отложенных и выброшенных апдейтов"""
+    started = time.monotonic()
+    bot_id = get_bot_id(bot_token)
+    client = get_telegram_client(bot_token)
+    # Строки остаются заблокированными до конца транзакции: другие воркеры их пропускают,
+    # а удаление из очереди коммитится вместе с результатами обработки
+    with client.pipeline():
+        with shared_db_transaction() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """SELECT id, payload, attempts, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - enqueued_at) AS wait_seconds
+                       FROM update_queue
+                       WHERE bot_id = %s AND available_at <= CURRENT_TIMESTAMP
+                       ORDER BY id
+                       LIMIT %s
+                       FOR UPDATE SKIP LOCKED""",
+                    (bot_id, batch_size)
+                )
+                rows = cur.fetchall()
+            if not rows:
+                return {'taken': 0}
+            
+            outcomes = process_update_chunk(conn, [row['payload'] for row in rows], bot_token)
+            retry_ids = []
+            dropped_ids = []
+            for row, outcome in zip(rows, outcomes):
+                if outcome not in ('failed', 'retry'):
+                    continue
+                if row['attempts'] + 1 < WORKER_MAX_ATTEMPTS:
+                    retry_ids.append(row['id'])
+                else:
+                    dropped_ids.append(row['id'])
+                    log_event('update_dropped', queue_id=row['id'], update_id=row['payload'].get('update_id'), attempts=row['attempts'] + 1)
+            
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM update_queue WHERE id = ANY(%s)",
+                    ([row['id'] for row in rows if row['id'] not in retry_ids],)
+                )
+                if retry_ids:
+                    cur.execute(
+                        """UPDATE update_queue
+                           SET attempts = attempts + 1, available_at = CURRENT_TIMESTAMP + make_interval(secs => %s * (attempts + 1))
+                           WHERE id = ANY(%s)""",
+                        (WORKER_RETRY_DELAY_SECONDS, retry_ids)
+                    )
+    
+    stats = {
+        'taken': len(rows),
+        'processed': outcomes.count('processed'),
+        'duplicates': outcomes.count('duplicate'),
+        'retried': len(retry_ids),
+        'dropped': len(dropped_ids),
+        'max_wait_seconds': round(max(float(row['wait_seconds']) for row in rows), 3),
+        'seconds': round(time.monotonic() - started, 4)
+    }
+    log_event('queue_batch', **stats)
+    return stats
+
+def listen_for_updates() -> Any:
+    """Отдельное соединение вне пула для LISTEN: вебхук шлёт NOTIFY update_queue после каждой вставки"""
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("LISTEN update_queue")
+    return conn
+
+def wait_for_updates(listen_conn, timeout: float):
+    if select.select([listen_conn], [], [], timeout)[0]:
+        listen_conn.poll()
+        listen_conn.notifies.clear()
+
+def run(bot_token: str, batch_size: int = BATCH_COMMIT_SIZE, once: bool = False,
+        idle_timeout: float = WORKER_IDLE_TIMEOUT_SECONDS) -> Dict[str, Any]:
+    '''
+    Business: Drain the deferred update queue filled by the webhook
+    Args: bot_token - Telegram bot token, batch_size - updates per transaction,
+          once - exit when the queue is empty, idle_timeout - max sleep between checks of an idle queue
+    Returns: totals of processed updates
+    '''
+    listen_conn = None if once else listen_for_updates()
+    totals = {'taken': 0, 'processed': 0, 'duplicates': 0, 'retried': 0, 'dropped': 0}
+    log_event('worker_started', batch_size=batch_size, once=once)
+    try:
+        while True:
+            stats = drain_batch(bot_token, batch_size)
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+            if stats['taken'] == batch_size:
+                continue
+            if once:
+                break
+            wait_for_updates(listen_conn, idle_timeout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if listen_conn is not None:
+            listen_conn.close()
+    
+    log_event('worker_stopped', **totals)
+    return totals
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Worker for updates queued by the webhook in deferred mode')
+    parser.add_argument('--batch-size', type=int, default=BATCH_COMMIT_SIZE, help='updates processed per transaction')
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty instead of waiting for new updates')
+    parser.add_argument('--idle-timeout', type=float, default=WORKER_IDLE_TIMEOUT_SECONDS, help='max seconds between checks of an idle queue')
+    args = parser.parse_args(argv)
+    
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        print('TELEGRAM_BOT_TOKEN is not configured', file=sys.stderr)
+        return 1
+    
+    run(bot_token, args.batch_size, args.once, args.idle_timeout)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
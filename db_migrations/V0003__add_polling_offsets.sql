@@ -0,0 +1,6 @@
+-- Смещение getUpdates для режима long polling
+CREATE TABLE IF NOT EXISTS polling_offsets (
+    bot_id BIGINT PRIMARY KEY,
+    update_offset BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,18 @@
+-- Справочник пользователей Telegram, пополняется из входящих апдейтов
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username VARCHAR(255),
+    first_name VARCHAR(255),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Поиск по юзернейму без учёта регистра; юзернейм принадлежит только одному пользователю
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username));
+
+-- Переносим уже известных пользователей из кошельков
+INSERT INTO users (user_id, username)
+SELECT DISTINCT ON (LOWER(username)) user_id, username
+FROM user_currency
+WHERE username IS NOT NULL AND username <> ''
+ORDER BY LOWER(username), updated_at DESC
+ON CONFLICT DO NOTHING;
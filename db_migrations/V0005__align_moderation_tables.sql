@@ -0,0 +1,65 @@
+-- Приводим chat_mutes и chat_bans к колонкам, которые использует вебхук:
+-- user_id, username и время окончания, ключ (chat_id, user_id)
+
+ALTER TABLE chat_mutes ADD COLUMN IF NOT EXISTS user_id BIGINT;
+ALTER TABLE chat_mutes ADD COLUMN IF NOT EXISTS username VARCHAR(255);
+ALTER TABLE chat_mutes ADD COLUMN IF NOT EXISTS muted_until TIMESTAMP;
+
+ALTER TABLE chat_bans ADD COLUMN IF NOT EXISTS user_id BIGINT;
+ALTER TABLE chat_bans ADD COLUMN IF NOT EXISTS username VARCHAR(255);
+ALTER TABLE chat_bans ADD COLUMN IF NOT EXISTS banned_until TIMESTAMP;
+
+-- Переносим старые записи; id берём из telegram_id или из справочника пользователей
+UPDATE chat_mutes m
+SET user_id = COALESCE(m.telegram_id, (SELECT u.user_id FROM users u WHERE LOWER(u.username) = LOWER(m.telegram_username))),
+    username = m.telegram_username,
+    muted_until = m.unmute_at;
+
+UPDATE chat_bans b
+SET user_id = COALESCE(b.telegram_id, (SELECT u.user_id FROM users u WHERE LOWER(u.username) = LOWER(b.telegram_username))),
+    username = b.telegram_username;
+
+-- Без user_id запись нельзя ни снять, ни применить в Telegram
+DELETE FROM chat_mutes WHERE user_id IS NULL OR muted_until IS NULL;
+DELETE FROM chat_bans WHERE user_id IS NULL;
+
+-- В chat_mutes не было уникальности: оставляем самый поздний мут
+DELETE FROM chat_mutes m
+USING chat_mutes newer
+WHERE m.chat_id = newer.chat_id AND m.user_id = newer.user_id
+  AND (m.muted_until, m.id) < (newer.muted_until, newer.id);
+
+-- Разные username могли указывать на одного пользователя: оставляем самый поздний бан
+DELETE FROM chat_bans b
+USING chat_bans newer
+WHERE b.chat_id = newer.chat_id AND b.user_id = newer.user_id
+  AND b.id < newer.id;
+
+DROP INDEX IF EXISTS idx_chat_mutes_chat_id;
+DROP INDEX IF EXISTS idx_chat_mutes_unmute_at;
+DROP INDEX IF EXISTS idx_chat_bans_chat_id;
+
+ALTER TABLE chat_mutes
+    DROP COLUMN id,
+    DROP COLUMN telegram_username,
+    DROP COLUMN telegram_id,
+    DROP COLUMN mute_duration_minutes,
+    DROP COLUMN unmute_at,
+    ALTER COLUMN user_id SET NOT NULL,
+    ALTER COLUMN muted_until SET NOT NULL,
+    ADD PRIMARY KEY (chat_id, user_id);
+
+ALTER TABLE chat_bans
+    DROP COLUMN id,
+    DROP COLUMN telegram_username,
+    DROP COLUMN telegram_id,
+    ALTER COLUMN user_id SET NOT NULL,
+    ADD PRIMARY KEY (chat_id, user_id);
+
+-- /mutelist и /banlist: диапазон по чату и времени окончания, username в индексе для index-only scan
+CREATE INDEX IF NOT EXISTS idx_chat_mutes_chat_until ON chat_mutes(chat_id, muted_until) INCLUDE (username);
+CREATE INDEX IF NOT EXISTS idx_chat_bans_chat_until ON chat_bans(chat_id, banned_until NULLS LAST) INCLUDE (username);
+
+-- Поиск истёкших по всем чатам; постоянные баны (banned_until IS NULL) не истекают и в индекс не попадают
+CREATE INDEX IF NOT EXISTS idx_chat_mutes_until ON chat_mutes(muted_until);
+CREATE INDEX IF NOT EXISTS idx_chat_bans_until ON chat_bans(banned_until) WHERE banned_until IS NOT NULL;
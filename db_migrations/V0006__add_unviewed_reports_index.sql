@@ -0,0 +1,5 @@
+-- Постраничный просмотр непрочитанных репортов по ключу (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_user_reports_unviewed ON user_reports(created_at DESC, id DESC) WHERE viewed = FALSE;
+
+-- Индекс по одному булеву полю заменён частичным индексом выше
+DROP INDEX IF EXISTS idx_user_reports_viewed;
@@ -0,0 +1,7 @@
+-- /mutelist и /banlist листаются по ключу (время окончания, user_id): добавляем user_id в индексы,
+-- для банов сортировка идёт по COALESCE(banned_until, 'infinity'), чтобы постоянные шли последними
+DROP INDEX IF EXISTS idx_chat_mutes_chat_until;
+CREATE INDEX IF NOT EXISTS idx_chat_mutes_chat_until ON chat_mutes(chat_id, muted_until, user_id) INCLUDE (username);
+
+DROP INDEX IF EXISTS idx_chat_bans_chat_until;
+CREATE INDEX IF NOT EXISTS idx_chat_bans_chat_until ON chat_bans(chat_id, (COALESCE(banned_until, 'infinity'::timestamp)), user_id) INCLUDE (username, banned_until);
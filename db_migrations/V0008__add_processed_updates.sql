@@ -0,0 +1,10 @@
+-- Обработанные update_id: повтор апдейта от Telegram подтверждается без повторной обработки
+CREATE TABLE IF NOT EXISTS processed_updates (
+    bot_id BIGINT NOT NULL,
+    update_id BIGINT NOT NULL,
+    processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (bot_id, update_id)
+);
+
+-- Очистка старых записей по времени
+CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at ON processed_updates(processed_at);
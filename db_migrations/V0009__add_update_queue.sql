@@ -0,0 +1,11 @@
+-- Очередь апдейтов для отложенной обработки: вебхук только вставляет строку, worker.py разбирает очередь
+CREATE TABLE IF NOT EXISTS update_queue (
+    id BIGSERIAL PRIMARY KEY,
+    bot_id BIGINT NOT NULL,
+    update_id BIGINT,
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (bot_id, update_id)
+);
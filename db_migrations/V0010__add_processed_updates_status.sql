@@ -0,0 +1,5 @@
+-- Вебхук коммитит отметку до обработки: status отличает начатые апдейты от завершённых,
+-- reply хранит inline-ответ, чтобы повтор от Telegram после таймаута получил тот же ответ
+ALTER TABLE processed_updates
+    ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'done',
+    ADD COLUMN IF NOT EXISTS reply TEXT;